@@ -23,15 +23,31 @@
 # 3. Extracting Association Rules
 # 4. Preparing the Script of the Study
 # 5. Making Product Recommendations to Users in the Cart Stage
+# 6. Compiled Rule Index for the Cart Stage
+# 7. Bitset Frequent Itemset Miner (Eclat)
+# 8. Per-Country Rule Mining and the Rule Store
+# 9. Streaming Ingestion with a Columnar Cache
+# 10. Whole-Cart Recommendations
+# 11. Sliding-Window Incremental Rules over InvoiceDate
 
 # !pip install mlxtend
+import os
+import time
+from itertools import combinations
+import numpy as np
 import pandas as pd
 pd.set_option('display.max_columns', None)
 # pd.set_option('display.max_rows', None)
 pd.set_option('display.width', 500)
 # ensures that the output is on a single line.
 pd.set_option('display.expand_frame_repr', False)
+from joblib import Parallel, delayed
+from openpyxl import load_workbook
 from mlxtend.frequent_patterns import apriori, association_rules
+from scipy.sparse import csc_matrix, csr_matrix, issparse, vstack
+from array_ops import gather_ranges, gather_rows
+from data_cache import cached_frame
+from model_store import attach_model, current_version, publish_model
 
 
 ############################################
@@ -194,13 +210,37 @@ def retail_data_prep(dataframe):
     return dataframe
 
 
+# The unstack / applymap version builds a dense invoices x products frame and calls a lambda per cell. The basket
+# matrix is built directly from the categorical codes of the invoices and the products instead: a sparse matrix of
+# the summed quantities (duplicated pairs are summed by the CSR conversion) and its > 0 pattern, a boolean CSR
+# matrix. create_invoice_product_df wraps it into a sparse boolean DataFrame, with the same sorted index as the
+# unstack version, which apriori mines without densifying.
+# mlxtend rejects a sparse frame whose first column name is an integer other than 0, and most StockCodes are
+# integers that sort first. The columns are therefore the positions of the items (0, 1, ...), the items themselves
+# (sorted, like the unstack columns) are kept in attrs["items"] and label_itemsets maps mined itemsets back to them.
+def basket_matrix(dataframe, id=False):
+    column = "StockCode" if id else "Description"
+    invoice_codes, invoices = pd.factorize(dataframe["Invoice"], sort=True)
+    item_codes, items = pd.factorize(dataframe[column], sort=True)
+    quantities = csr_matrix((dataframe["Quantity"].values.astype(np.float64), (invoice_codes, item_codes)),
+                            shape=(len(invoices), len(items)))
+    quantities.sum_duplicates()
+    baskets = csr_matrix(quantities > 0)
+    return baskets, pd.Index(invoices, name="Invoice"), pd.Index(items, name=column)
+
+
 def create_invoice_product_df(dataframe, id=False):
-    if id:
-        return dataframe.groupby(['Invoice', "StockCode"])['Quantity'].sum().unstack().fillna(0). \
-            applymap(lambda x: 1 if x > 0 else 0)
-    else:
-        return dataframe.groupby(['Invoice', 'Description'])['Quantity'].sum().unstack().fillna(0). \
-            applymap(lambda x: 1 if x > 0 else 0)
+    baskets, invoices, items = basket_matrix(dataframe, id)
+    invoice_product_df = pd.DataFrame.sparse.from_spmatrix(baskets, index=invoices)
+    invoice_product_df.attrs["items"] = items
+    return invoice_product_df
+
+
+def label_itemsets(frequent_itemsets, items):
+    items = np.asarray(items, dtype=object)
+    frequent_itemsets["itemsets"] = [frozenset(items[list(itemset)].tolist())
+                                     for itemset in frequent_itemsets["itemsets"]]
+    return frequent_itemsets
 
 
 def check_id(dataframe, stock_code):
@@ -208,11 +248,17 @@ def check_id(dataframe, stock_code):
     print(product_name)
 
 
-def create_rules(dataframe, id=True, country="France"):
-    dataframe = dataframe[dataframe['Country'] == country]
+# miner: apriori or eclat (section 7), both return the same frequent itemsets. country=None mines all the countries
+def create_rules(dataframe, id=True, country="France", min_support=0.01, miner=apriori, max_len=None):
+    if country is not None:
+        dataframe = dataframe[dataframe['Country'] == country]
     dataframe = create_invoice_product_df(dataframe, id)
-    frequent_itemsets = apriori(dataframe, min_support=0.01, use_colnames=True)
-    rules = association_rules(frequent_itemsets, metric="support", min_threshold=0.01)
+    frequent_itemsets = miner(dataframe, min_support=min_support, max_len=max_len)
+    if frequent_itemsets.empty:
+        # association_rules doesn't accept an empty input (small countries)
+        return pd.DataFrame({"antecedents": [], "consequents": [], "support": [], "confidence": [], "lift": []})
+    frequent_itemsets = label_itemsets(frequent_itemsets, dataframe.attrs["items"])
+    rules = association_rules(frequent_itemsets, metric="support", min_threshold=min_support)
     return rules
 
 df = df_.copy()
@@ -247,6 +293,9 @@ recommendation_list[0:3]
 check_id(df, 22326)
 
 def arl_recommender(rules_df, product_id, rec_count=1):
+    # A compiled rule index (section 6) is answered without scanning the rules
+    if isinstance(rules_df, dict):
+        return rule_index_recommender(rules_df, product_id, rec_count)
     sorted_rules = rules_df.sort_values("lift", ascending=False)
     recommendation_list = []
     for i, product in enumerate(sorted_rules["antecedents"]):
@@ -259,4 +308,611 @@ def arl_recommender(rules_df, product_id, rec_count=1):
 
 arl_recommender(rules, 22492, 1)
 arl_recommender(rules, 22492, 2)
-arl_recommender(rules, 22492, 3)
\ No newline at end of file
+arl_recommender(rules, 22492, 3)
+
+
+############################################
+# 6. Compiled Rule Index for the Cart Stage
+############################################
+# arl_recommender sorts all the rules by lift and walks every antecedent in a Python loop on each call.
+# compile_rule_index does this once and keeps the rules in flat arrays, in descending lift order:
+## lift, antecedent_lengths           - per rule
+## consequent_indptr, consequents     - the consequents of rule r are consequents[consequent_indptr[r]:consequent_indptr[r + 1]]
+## items, indptr, rule_ids            - postings: the rules whose antecedents contain items[p] are
+##                                      rule_ids[indptr[p]:indptr[p + 1]], in lift order
+## recommendations                    - the first consequent of each posting entry (what arl_recommender returns)
+## antecedent_indptr, antecedent_codes - the antecedent items of each rule, as positions in items
+## consequent_codes                   - the consequents as positions in items
+## anchor_keys                        - each rule under its rarest antecedent item only, as anchor * rules + rule id,
+##                                      sorted (section 10)
+# A lookup is one index search and one slice, O(rec_count). The rules are sorted with a stable sort, so rules with
+# the same lift keep the order of the association_rules output.
+
+def compile_rule_index(rules_df):
+    rules_df = rules_df.sort_values("lift", ascending=False, kind="stable")
+    antecedents = [list(antecedent) for antecedent in rules_df["antecedents"]]
+    consequents = [list(consequent) for consequent in rules_df["consequents"]]
+    antecedent_lengths = np.array([len(antecedent) for antecedent in antecedents], dtype=np.int32)
+    consequent_lengths = np.array([len(consequent) for consequent in consequents], dtype=np.int32)
+    consequent_indptr = np.concatenate([[0], np.cumsum(consequent_lengths)]).astype(np.int64)
+    flat_consequents = pd.Series([item for consequent in consequents for item in consequent], dtype=object).values
+    # One posting entry per (antecedent item, rule), grouped by item with the rules kept in lift order
+    rule_ids = np.repeat(np.arange(len(antecedents), dtype=np.int32), antecedent_lengths)
+    # Consequent items are in items as well (without postings), so that the cart recommender works on codes
+    codes, items = pd.factorize(pd.Series([item for antecedent in antecedents for item in antecedent] +
+                                          flat_consequents.tolist(), dtype=object))
+    codes, consequent_codes = codes[:len(rule_ids)], codes[len(rule_ids):]
+    order = np.argsort(codes, kind="stable")
+    postings = np.bincount(codes, minlength=len(items))
+    antecedent_indptr = np.concatenate([[0], np.cumsum(antecedent_lengths)]).astype(np.int64)
+    # The anchor of a rule is its antecedent item with the fewest postings
+    anchors = codes[np.lexsort((postings[codes], rule_ids))][antecedent_indptr[:-1]]
+    return {"lift": rules_df["lift"].values,
+            "antecedent_lengths": antecedent_lengths,
+            "consequent_indptr": consequent_indptr,
+            "consequents": flat_consequents,
+            "items": pd.Index(items),
+            "indptr": np.concatenate([[0], np.cumsum(postings)]).astype(np.int64),
+            "rule_ids": rule_ids[order],
+            "recommendations": flat_consequents[consequent_indptr[rule_ids[order]]],
+            "antecedent_indptr": antecedent_indptr,
+            "antecedent_codes": codes.astype(np.int32),
+            "consequent_codes": consequent_codes.astype(np.int32),
+            "anchor_keys": np.sort(anchors.astype(np.int64) * len(antecedents) + np.arange(len(antecedents)))}
+
+
+def rule_index_recommender(rule_index, product_id, rec_count=1):
+    position = rule_index["items"].get_indexer([product_id])[0]
+    if position == -1:
+        return []
+    start = rule_index["indptr"][position]
+    return rule_index["recommendations"][start:min(start + rec_count, rule_index["indptr"][position + 1])].tolist()
+
+
+rule_index = compile_rule_index(rules)
+
+arl_recommender(rule_index, 22492, 1)
+arl_recommender(rule_index, 22492, 3)
+
+
+############################################
+# 7. Bitset Frequent Itemset Miner (Eclat)
+############################################
+# apriori generates every candidate of a level and tests it against the whole basket matrix, which runs out of
+# memory or time for all the countries together or for lower supports. eclat mines the same itemsets depth-first
+# on a vertical layout: each frequent item is a bitset over the invoices (packed 8 invoices per byte), the invoices
+# of an itemset are the AND of its items' bitsets and its support is the popcount of that. All the extensions of a
+# prefix are intersected and counted in one vectorized step, and only the bitsets of the current path are held.
+# The output has the schema of apriori (support, itemsets as frozensets) with the itemsets in the same order, by
+# length and then by column position, so association_rules works on it unchanged.
+
+if hasattr(np, "bitwise_count"):
+    def _popcount(bits):
+        return np.bitwise_count(bits).sum(axis=-1, dtype=np.int64)
+else:
+    # numpy < 2.0: popcount through a lookup table of the 256 byte values
+    _POPCOUNT_TABLE = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+    def _popcount(bits):
+        return _POPCOUNT_TABLE[bits].sum(axis=-1, dtype=np.int64)
+
+
+def _transaction_matrix(dataframe):
+    if issparse(dataframe):
+        return csc_matrix(dataframe, dtype=bool), np.arange(dataframe.shape[1])
+    if hasattr(dataframe, "sparse"):
+        return dataframe.sparse.to_coo().tocsc().astype(bool), dataframe.columns
+    return csc_matrix(dataframe.values.astype(bool)), dataframe.columns
+
+
+def _item_bitsets(transactions, columns):
+    # Bit t of row i is set when invoice t contains the item of column columns[i]
+    positions, lengths = gather_rows(transactions.indptr, columns)
+    invoices = transactions.indices[positions]
+    bits = np.zeros((len(columns), (transactions.shape[0] + 7) // 8), dtype=np.uint8)
+    np.bitwise_or.at(bits, (np.repeat(np.arange(len(columns)), lengths), invoices >> 3),
+                     (0x80 >> (invoices & 7)).astype(np.uint8))
+    return bits
+
+
+def eclat(dataframe, min_support=0.5, use_colnames=False, max_len=None):
+    if min_support <= 0.0 or min_support > 1.0:
+        raise ValueError(f"`min_support` must be a positive number within the interval `(0, 1]`. Got {min_support}.")
+    transactions, column_names = _transaction_matrix(dataframe)
+    n_rows = float(transactions.shape[0])
+    support = np.diff(transactions.indptr) / n_rows
+    # Same support test as apriori (count / rows >= min_support), so both return the same itemsets
+    frequent = np.flatnonzero(support >= min_support)
+    bits = _item_bitsets(transactions, frequent)
+    itemsets, supports = [(column,) for column in frequent], support[frequent].tolist()
+
+    def extend(prefix, prefix_bits, extension_bits, extensions):
+        if max_len is not None and len(prefix) >= max_len:
+            return
+        candidate_bits = prefix_bits & extension_bits
+        candidate_supports = _popcount(candidate_bits) / n_rows
+        keep = np.flatnonzero(candidate_supports >= min_support)
+        candidate_bits, extensions = candidate_bits[keep], extensions[keep]
+        for position, (item, item_support) in enumerate(zip(extensions, candidate_supports[keep])):
+            itemset = prefix + (item,)
+            itemsets.append(itemset)
+            supports.append(item_support)
+            extend(itemset, candidate_bits[position], candidate_bits[position + 1:], extensions[position + 1:])
+
+    for position, item in enumerate(frequent):
+        extend((item,), bits[position], bits[position + 1:], frequent[position + 1:])
+    order = sorted(range(len(itemsets)), key=lambda index: (len(itemsets[index]), itemsets[index]))
+    names = np.asarray(column_names, dtype=object) if use_colnames else np.arange(len(column_names))
+    return pd.DataFrame({"support": np.array(supports, dtype=np.float64)[order],
+                         "itemsets": [frozenset(names[list(itemsets[index])].tolist()) for index in order]})
+
+
+# Benchmark of the two miners on the same basket matrix: seconds per miner and whether the itemsets match.
+# apriori runs out of memory or takes hours on all the countries together, so the script benchmarks France only
+def benchmark_miners(dataframe, min_supports=(0.05, 0.03, 0.02, 0.01), id=True):
+    baskets = create_invoice_product_df(dataframe, id)
+    results = []
+    for min_support in min_supports:
+        start = time.perf_counter()
+        apriori_itemsets = apriori(baskets, min_support=min_support, use_colnames=True)
+        apriori_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        eclat_itemsets = eclat(baskets, min_support=min_support, use_colnames=True)
+        eclat_seconds = time.perf_counter() - start
+        results.append({"min_support": min_support,
+                        "itemsets": len(eclat_itemsets),
+                        "apriori_seconds": apriori_seconds,
+                        "eclat_seconds": eclat_seconds,
+                        "same_itemsets": set(apriori_itemsets["itemsets"]) == set(eclat_itemsets["itemsets"])})
+    return pd.DataFrame(results)
+
+
+benchmark_miners(df[df['Country'] == "France"])
+
+rules = create_rules(df, min_support=0.005, miner=eclat)
+
+
+############################################
+# 8. Per-Country Rule Mining and the Rule Store
+############################################
+# create_rules mines one country at a time into an in-memory DataFrame. mine_country_rules mines every country,
+# plus a global model ("ALL"), in a process pool. Each worker compiles its rules (section 6) and publishes them to
+# the model store (model_store.py) under the country name, so rebuilding a country swaps its version atomically
+# and nothing but a summary row is sent back. The countries are dispatched largest first: the slowest jobs start
+# right away and the small ones fill the gaps, so the wall-clock time is close to the slowest single job.
+# With a fractional min_support, every subset of a basket is frequent in a country with a handful of invoices: the
+# work grows exponentially with the basket size and the rules would be backed by a single basket. Countries with
+# fewer than min_invoices invoices are not mined (RuleStore answers them with "ALL") and max_len bounds the itemsets.
+# RuleStore attaches to a country's rules on its first request and re-attaches when a new version is published.
+
+RULE_INDEX_ARRAYS = ["lift", "antecedent_lengths", "consequent_indptr", "consequents", "items", "indptr", "rule_ids",
+                     "recommendations", "antecedent_indptr", "antecedent_codes", "consequent_codes", "anchor_keys"]
+
+
+def rule_index_arrays(rule_index):
+    arrays = {name: rule_index[name] for name in RULE_INDEX_ARRAYS}
+    arrays["items"] = np.asarray(rule_index["items"], dtype=object)
+    arrays["lift"] = np.asarray(rule_index["lift"], dtype=np.float64)
+    return arrays
+
+
+def rule_index_from_arrays(arrays):
+    rule_index = dict(arrays)
+    rule_index["items"] = pd.Index(arrays["items"], dtype=object)
+    return rule_index
+
+
+def _mine_country(store_dir, dataframe, country, id, min_support, miner, max_len):
+    start = time.perf_counter()
+    rules = create_rules(dataframe, id, None, min_support, miner, max_len)
+    meta = {"country": country, "invoices": int(dataframe["Invoice"].nunique()), "rules": len(rules),
+            "min_support": min_support, "max_len": max_len}
+    version = publish_model(store_dir, country, rule_index_arrays(compile_rule_index(rules)), meta)
+    return dict(meta, version=version, seconds=time.perf_counter() - start)
+
+
+def mine_country_rules(dataframe, store_dir, id=True, min_support=0.01, miner=eclat, countries=None, min_invoices=100,
+                       max_len=4, n_jobs=-1):
+    invoices = dataframe.groupby("Country", observed=True)["Invoice"].nunique()
+    if countries is not None:
+        invoices = invoices[invoices.index.isin(countries)]
+    invoices = invoices[invoices >= min_invoices]
+    jobs = [(country, dataframe[dataframe["Country"] == country]) for country in invoices.index]
+    if countries is None or "ALL" in countries:
+        jobs.append(("ALL", dataframe))
+    # Largest first (by invoices), the global model is the largest of all
+    jobs.sort(key=lambda job: job[1]["Invoice"].nunique(), reverse=True)
+    results = Parallel(n_jobs=n_jobs, return_as="generator_unordered")(
+        delayed(_mine_country)(store_dir, country_df, country, id, min_support, miner, max_len)
+        for country, country_df in jobs)
+    summary = []
+    for result in results:
+        summary.append(result)
+        print(f"{result['country']}: {result['rules']} rules in {result['seconds']:.1f}s")
+    return pd.DataFrame(summary).sort_values("invoices", ascending=False, kind="stable").reset_index(drop=True)
+
+
+class RuleStore:
+    def __init__(self, store_dir, fallback="ALL"):
+        self.store_dir = store_dir
+        # Countries without a rule model are answered with the global model
+        self.fallback = fallback
+        self.indexes = {}
+
+    def get(self, country):
+        version = current_version(self.store_dir, country)
+        if version is None:
+            if country == self.fallback:
+                raise KeyError(country)
+            return self.get(self.fallback)
+        if country not in self.indexes or self.indexes[country]["version"] != version:
+            model = attach_model(self.store_dir, country, version)
+            rule_index = rule_index_from_arrays(model["arrays"])
+            rule_index["version"], rule_index["meta"] = version, model["meta"]
+            self.indexes[country] = rule_index
+        return self.indexes[country]
+
+    def recommend(self, country, product_id, rec_count=1):
+        return arl_recommender(self.get(country), product_id, rec_count)
+
+
+country_rules = mine_country_rules(df, "models/rules", min_support=0.01)
+
+rule_store = RuleStore("models/rules")
+rule_store.recommend("France", 22492, 3)
+rule_store.recommend("Germany", 22492, 3)
+
+
+############################################
+# 9. Streaming Ingestion with a Columnar Cache
+############################################
+# pd.read_excel loads the whole sheet into memory (about half a minute for the 540k rows) on every run, and
+# retail_data_prep then filters a full copy. read_retail_sheet streams the sheet with openpyxl in read-only mode
+# and drops the rows retail_data_prep drops (missing values, cancelled invoices, Quantity or Price <= 0) while
+# streaming, then types the columns:
+## Invoice      - str, like retail_data_prep
+## StockCode    - category (the codes are ints or strs, as read_excel returns them)
+## Description  - str
+## Quantity     - int32
+## InvoiceDate  - datetime64[s]
+## Price        - float64
+## Customer ID  - int32
+## Country      - category
+# load_retail_data caches the result with data_cache.py (one cache per sheet), so later runs memory-map it in a
+# fraction of a second. The outlier thresholds depend on the whole filtered data and are applied after loading
+# by clip_with_thresholds, which returns new columns instead of writing into the read-only cache.
+
+RETAIL_DTYPES = {"Invoice": object, "StockCode": "category", "Description": object, "Quantity": np.int32,
+                 "InvoiceDate": "datetime64[s]", "Price": np.float64, "Customer ID": np.int32, "Country": "category"}
+
+
+def read_retail_sheet(path, sheet_name="Year 2010-2011"):
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook[sheet_name].iter_rows(values_only=True)
+        header = list(next(rows))
+        invoice, quantity, price = header.index("Invoice"), header.index("Quantity"), header.index("Price")
+        columns = [[] for _ in header]
+        for row in rows:
+            if None in row or "C" in str(row[invoice]) or row[quantity] <= 0 or row[price] <= 0:
+                continue
+            for values, value in zip(columns, row):
+                values.append(value)
+    finally:
+        workbook.close()
+    data = {}
+    for name, values in zip(header, columns):
+        dtype = RETAIL_DTYPES.get(name, object)
+        if name == "Invoice":
+            data[name] = np.array([str(value) for value in values], dtype=object)
+        elif dtype == "category":
+            data[name] = pd.Categorical(values)
+        else:
+            data[name] = np.array(values, dtype=dtype)
+    return pd.DataFrame(data)
+
+
+def load_retail_data(path="datasets/online_retail_II.xlsx", sheet_name="Year 2010-2011"):
+    cache_dir = os.path.join(os.path.dirname(path), ".cache", sheet_name)
+    return cached_frame(path, lambda source_path: read_retail_sheet(source_path, sheet_name), cache_dir)
+
+
+def clip_with_thresholds(dataframe, variables=("Quantity", "Price")):
+    dataframe = dataframe.copy(deep=False)
+    for variable in variables:
+        low_limit, up_limit = outlier_thresholds(dataframe, variable)
+        # Same values as replace_with_thresholds (which upcasts an integer column to float as well)
+        dataframe[variable] = dataframe[variable].astype(np.float64).clip(low_limit, up_limit)
+    return dataframe
+
+
+df = clip_with_thresholds(load_retail_data())
+rules = create_rules(df, miner=eclat)
+
+
+############################################
+# 10. Whole-Cart Recommendations
+############################################
+# arl_recommender answers for one product of the cart. cart_recommender answers for the whole cart: the rules
+# whose whole antecedent is contained in the cart, and their consequents that are not in the cart yet, by lift.
+# A rule can only match if its anchor (its rarest antecedent item, section 6) is in the cart, so the candidates are
+# the anchor postings of the cart items, each rule appearing once and only under a rare item. A candidate matches
+# if all its antecedent items are in the cart, which is checked for all the candidates at once with a boolean mask
+# over the items. Rule ids are in lift order, so the rules are scanned in windows of rule ids (growing 4x each
+# time) and the scan stops as soon as rec_count consequents are found: large carts that match a large part of the
+# rules only touch the top of them. The window bounds of every cart item are one np.searchsorted on anchor_keys.
+
+def cart_recommender(rule_index, cart, rec_count=5, window=4096):
+    items, anchor_keys = rule_index["items"], rule_index["anchor_keys"]
+    n_rules = len(rule_index["lift"])
+    codes = items.get_indexer(pd.unique(pd.Series(list(cart), dtype=object)))
+    codes = codes[codes >= 0].astype(np.int64)
+    in_cart = np.zeros(len(items), dtype=bool)
+    in_cart[codes] = True
+    # Items that can't be recommended: the cart and the consequents already recommended
+    excluded = in_cart.copy()
+    recommendations = []
+    low = 0
+    while low < n_rules and len(recommendations) < rec_count:
+        high = min(low + window, n_rules)
+        starts = np.searchsorted(anchor_keys, codes * n_rules + low)
+        positions = gather_ranges(starts, np.searchsorted(anchor_keys, codes * n_rules + high) - starts)
+        candidates = anchor_keys[positions] % n_rules
+        positions, lengths = gather_rows(rule_index["antecedent_indptr"], candidates)
+        hits = np.bincount(np.repeat(np.arange(len(candidates)), lengths),
+                           weights=in_cart[rule_index["antecedent_codes"][positions]], minlength=len(candidates))
+        matches = np.sort(candidates[hits == lengths])
+        positions, _ = gather_rows(rule_index["consequent_indptr"], matches)
+        consequents = rule_index["consequent_codes"][positions]
+        consequents = consequents[~excluded[consequents]]
+        _, first = np.unique(consequents, return_index=True)
+        consequents = consequents[np.sort(first)]
+        excluded[consequents] = True
+        recommendations.extend(consequents.tolist())
+        low, window = high, window * 4
+    return items[recommendations[:rec_count]].tolist()
+
+
+cart_recommender(rule_index, [22492, 22326, 22423], 5)
+cart_recommender(rule_store.get("France"), [22492, 22326, 22423], 5)
+
+
+############################################
+# 11. Sliding-Window Incremental Rules over InvoiceDate
+############################################
+# create_rules re-mines the whole history on every refresh. SlidingWindowRules keeps the rules of the invoices of
+# the last window_days days (by InvoiceDate) and updates them as invoices arrive and expire, with the negative
+# border method: it keeps the counts of the frequent itemsets and of their negative border (the infrequent
+# itemsets whose subsets are all frequent). An itemset can only become frequent after one of its border itemsets
+# has, so on each update:
+## the tracked counts are updated with the invoices that arrived minus the ones that expired (bitset counts over
+## these invoices only, section 7)
+## the frequent itemsets and the border are re-derived level by level from the counts (apriori candidate
+## generation), and only the candidates that weren't tracked are counted over the whole window
+## the rules of the itemsets that became frequent are added and the rules of the ones that stopped being frequent
+## are removed, the metrics of the other rules are recomputed from the counts with array operations
+# The rules are the ones create_rules returns for the invoices of the window (metric="support", min_support),
+# optionally filtered by min_confidence and min_lift. update returns the rules that crossed the thresholds:
+# (added, removed). Invoices are expected to arrive whole, a basket is not updated after it arrived.
+
+def _itemset_counts(transactions, itemsets, chunk_size=8192):
+    # Number of transactions (rows of a CSC matrix) that contain each itemset (rows of an int array)
+    counts = np.zeros(len(itemsets), dtype=np.int64)
+    if len(itemsets) == 0 or transactions.shape[0] == 0:
+        return counts
+    columns = np.unique(itemsets)
+    bits = _item_bitsets(transactions, columns)
+    local = np.searchsorted(columns, itemsets)
+    for start in range(0, len(itemsets), chunk_size):
+        chunk = local[start:start + chunk_size]
+        intersection = bits[chunk[:, 0]]
+        for position in range(1, chunk.shape[1]):
+            intersection &= bits[chunk[:, position]]
+        counts[start:start + chunk_size] = _popcount(intersection)
+    return counts
+
+
+def _candidate_itemsets(level):
+    # Apriori candidate generation: join the itemsets of a level that share all but their last item, and keep the
+    # candidates whose subsets are all in the level
+    level_set, candidates = set(level), []
+    prefixes = {}
+    for itemset in level:
+        prefixes.setdefault(itemset[:-1], []).append(itemset[-1])
+    for prefix, last_items in prefixes.items():
+        for first, second in combinations(sorted(last_items), 2):
+            candidate = prefix + (first, second)
+            if len(candidate) == 2 or all(subset in level_set for subset in combinations(candidate, len(candidate) - 1)):
+                candidates.append(candidate)
+    return candidates
+
+
+class SlidingWindowRules:
+    def __init__(self, window_days=365, min_support=0.01, id=True, max_len=None, min_confidence=0.0, min_lift=0.0):
+        self.window = pd.Timedelta(days=window_days)
+        self.min_support, self.id, self.max_len = min_support, id, max_len
+        self.min_confidence, self.min_lift = min_confidence, min_lift
+        # Invoices of the window: basket matrix over the item codes of items, and the date of each invoice
+        self.items = pd.Index([], dtype=object)
+        self.baskets = csr_matrix((0, 0), dtype=bool)
+        self.invoice_dates = np.array([], dtype="datetime64[s]")
+        self.item_counts = np.zeros(0, dtype=np.int64)
+        # Itemsets (sorted tuples of item codes) get a slot each, with their count and whether they are frequent
+        self.slots, self.itemsets = {}, []
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.frequent = np.zeros(0, dtype=bool)
+        self.lengths = np.zeros(0, dtype=np.int32)
+        # Item codes of each slot's itemset, padded with -1
+        self.codes = np.full((0, 1), -1, dtype=np.int64)
+        # Tracked itemsets of each length >= 2 (frequent and border: the candidates of the level), as a set and as
+        # slots, and frequent itemsets of each length
+        self.candidates, self.candidate_slots, self.frequent_sets = {}, {}, {1: set()}
+        # Rules: (itemset, antecedent, consequent) slots and whether they pass min_confidence / min_lift
+        self.rule_slots = np.zeros((0, 3), dtype=np.int64)
+        self.active = np.zeros(0, dtype=bool)
+
+    def _slot(self, itemset):
+        if itemset not in self.slots:
+            self.slots[itemset] = len(self.itemsets)
+            self.itemsets.append(itemset)
+        return self.slots[itemset]
+
+    def _grow_slots(self):
+        # Arrays of the slots created since the last call
+        itemsets = self.itemsets[len(self.counts):]
+        lengths = np.array([len(itemset) for itemset in itemsets], dtype=np.int32)
+        width = max(self.codes.shape[1], lengths.max(initial=1))
+        codes = np.full((len(itemsets), width), -1, dtype=np.int64)
+        for length in np.unique(lengths):
+            at = np.flatnonzero(lengths == length)
+            codes[at, :length] = [itemsets[position] for position in at]
+        self.codes = np.vstack([np.pad(self.codes, ((0, 0), (0, width - self.codes.shape[1])), constant_values=-1),
+                                codes])
+        self.counts = np.concatenate([self.counts, np.zeros(len(lengths), dtype=np.int64)])
+        self.frequent = np.concatenate([self.frequent, np.zeros(len(lengths), dtype=bool)])
+        self.lengths = np.concatenate([self.lengths, lengths])
+
+    def _tracked_slots(self):
+        return np.concatenate([np.zeros(0, dtype=np.int64)] + list(self.candidate_slots.values()))
+
+    def _slot_counts(self, transactions, slots):
+        counts = np.zeros(len(slots), dtype=np.int64)
+        if transactions.shape[0] == 0:
+            return counts
+        transactions = transactions.tocsc()
+        for length in np.unique(self.lengths[slots]):
+            at = np.flatnonzero(self.lengths[slots] == length)
+            counts[at] = _itemset_counts(transactions, self.codes[slots[at], :length])
+        return counts
+
+    def _is_frequent(self, counts):
+        n_invoices = self.baskets.shape[0]
+        # Same support test as apriori and eclat
+        return counts / n_invoices >= self.min_support if n_invoices else np.zeros(len(counts), dtype=bool)
+
+    def update(self, dataframe):
+        baskets, invoices, items = basket_matrix(dataframe, self.id)
+        self.items = self.items.append(items[~items.isin(self.items)])
+        n_items = len(self.items)
+        baskets = csr_matrix((baskets.data, self.items.get_indexer(items)[baskets.indices], baskets.indptr),
+                             shape=(baskets.shape[0], n_items))
+        dates = dataframe.groupby("Invoice")["InvoiceDate"].min().reindex(invoices).values.astype("datetime64[s]")
+        window_baskets = csr_matrix((self.baskets.data, self.baskets.indices, self.baskets.indptr),
+                                    shape=(self.baskets.shape[0], n_items))
+        all_dates = np.concatenate([self.invoice_dates, dates])
+        keep = all_dates > all_dates.max() - self.window.to_timedelta64()
+        old_keep, new_keep = keep[:len(self.invoice_dates)], keep[len(self.invoice_dates):]
+        added, removed = baskets[new_keep], window_baskets[~old_keep]
+        self.baskets = vstack([window_baskets[old_keep], added]).tocsr()
+        self.invoice_dates = all_dates[keep]
+        self.item_counts = np.concatenate([self.item_counts, np.zeros(n_items - len(self.item_counts), np.int64)]) + \
+            np.asarray(added.sum(axis=0)).ravel() - np.asarray(removed.sum(axis=0)).ravel()
+        tracked = self._tracked_slots()
+        self.counts[tracked] += self._slot_counts(added, tracked) - self._slot_counts(removed, tracked)
+        return self._update_rules(*self._update_itemsets())
+
+    def _update_itemsets(self):
+        # Level by level: the itemsets that became frequent (became) or stopped being frequent (stopped) at a level
+        # are the only changes to the candidates of the next level. A candidate containing a stopped itemset is
+        # dropped, and the supersets of a became itemset by one frequent item are new candidates if all their
+        # subsets are frequent. Only the new candidates are counted over the whole window.
+        frequent_items = np.flatnonzero(self._is_frequent(self.item_counts))
+        level = set((item,) for item in frequent_items.tolist())
+        became, stopped = level - self.frequent_sets[1], self.frequent_sets[1] - level
+        # Candidates are made of items that were frequent when they were added, new ones of the frequent items
+        old_items, extensions = [item for item, in self.frequent_sets[1]], frequent_items.tolist()
+        single_slots = np.array([self._slot(itemset) for itemset in level], dtype=np.int64)
+        self._grow_slots()
+        self.counts[single_slots] = self.item_counts[[self.itemsets[slot][0] for slot in single_slots]]
+        self.frequent[self.lengths == 1] = False
+        self.frequent[single_slots] = True
+        self.frequent_sets[1] = level
+        all_became, all_stopped = [], []
+        length, window = 1, None
+        while self.max_len is None or length < self.max_len:
+            candidates = self.candidates.setdefault(length + 1, set())
+            slots = self.candidate_slots.setdefault(length + 1, np.zeros(0, dtype=np.int64))
+            dropped = set(tuple(sorted(itemset + (item,))) for itemset in stopped for item in old_items) & candidates
+            if dropped:
+                candidates.difference_update(dropped)
+                slots = slots[~np.isin(slots, [self.slots[candidate] for candidate in dropped])]
+            new = []
+            for itemset in became:
+                for item in extensions:
+                    candidate = tuple(sorted(itemset + (item,)))
+                    if item not in itemset and candidate not in candidates and \
+                            all(subset in level for subset in combinations(candidate, length)):
+                        candidates.add(candidate)
+                        new.append(candidate)
+            if new:
+                # Candidates that weren't tracked are counted over the whole window
+                window = self.baskets.tocsc() if window is None else window
+                new_slots = np.array([self._slot(candidate) for candidate in new], dtype=np.int64)
+                self._grow_slots()
+                self.counts[new_slots] = _itemset_counts(window, np.array(new))
+                slots = np.concatenate([slots, new_slots])
+            self.candidate_slots[length + 1] = slots
+            was_frequent = np.flatnonzero(self.frequent & (self.lengths == length + 1))
+            is_frequent = slots[self._is_frequent(self.counts[slots])]
+            self.frequent[was_frequent] = False
+            self.frequent[is_frequent] = True
+            became = set(self.itemsets[slot] for slot in np.setdiff1d(is_frequent, was_frequent))
+            stopped = set(self.itemsets[slot] for slot in np.setdiff1d(was_frequent, is_frequent))
+            level = self.frequent_sets.setdefault(length + 1, set())
+            level.difference_update(stopped)
+            level.update(became)
+            all_became += [self.slots[itemset] for itemset in became]
+            all_stopped += [self.slots[itemset] for itemset in stopped]
+            # Deeper levels can change without any change at this level, as their counts changed
+            if not candidates and not stopped:
+                break
+            length += 1
+        return np.array(all_became, dtype=np.int64), np.array(all_stopped, dtype=np.int64)
+
+    def _update_rules(self, became, stopped):
+        # Rules of the itemsets that stopped being frequent are removed, the itemsets that became frequent add theirs
+        removed_rules = np.isin(self.rule_slots[:, 0], stopped)
+        new_rules = []
+        for slot in became.tolist():
+            itemset = self.itemsets[slot]
+            for length in range(1, len(itemset)):
+                for antecedent in combinations(itemset, length):
+                    consequent = tuple(item for item in itemset if item not in antecedent)
+                    new_rules.append((slot, self.slots[antecedent], self.slots[consequent]))
+        gone = self.rule_slots[removed_rules & self.active]
+        self.rule_slots = np.concatenate([self.rule_slots[~removed_rules], np.array(new_rules, dtype=np.int64).reshape(-1, 3)])
+        was_active = np.concatenate([self.active[~removed_rules], np.zeros(len(new_rules), dtype=bool)])
+        metrics = self._rule_metrics(self.rule_slots)
+        self.active = (metrics["confidence"] >= self.min_confidence) & (metrics["lift"] >= self.min_lift)
+        return self._rules_frame(self.rule_slots[self.active & ~was_active]), \
+            self._rules_frame(np.concatenate([gone, self.rule_slots[was_active & ~self.active]]))
+
+    def _rule_metrics(self, rule_slots):
+        n_invoices = max(self.baskets.shape[0], 1)
+        counts = self.counts[rule_slots]
+        metrics = {"antecedent support": counts[:, 1] / n_invoices,
+                   "consequent support": counts[:, 2] / n_invoices,
+                   "support": counts[:, 0] / n_invoices}
+        with np.errstate(divide="ignore", invalid="ignore"):
+            metrics["confidence"] = metrics["support"] / metrics["antecedent support"]
+            metrics["lift"] = metrics["confidence"] / metrics["consequent support"]
+        return metrics
+
+    def _rules_frame(self, rule_slots):
+        # In the schema of association_rules
+        labels = np.asarray(self.items, dtype=object)
+        frame = pd.DataFrame({"antecedents": [frozenset(labels[list(self.itemsets[slot])].tolist())
+                                              for slot in rule_slots[:, 1]],
+                              "consequents": [frozenset(labels[list(self.itemsets[slot])].tolist())
+                                              for slot in rule_slots[:, 2]]})
+        return frame.assign(**self._rule_metrics(rule_slots))
+
+    def rules(self):
+        return self._rules_frame(self.rule_slots[self.active])
+
+
+window_rules = SlidingWindowRules(window_days=90, min_support=0.01)
+for day, day_df in df[df['Country'] == "France"].groupby(df["InvoiceDate"].dt.date):
+    added, removed = window_rules.update(day_df)
+
+rule_index = compile_rule_index(window_rules.rules())
@@ -0,0 +1,48 @@
+###########################################
+# Shared Array Operations
+###########################################
+# Vectorized helpers shared by the recommender scripts.
+
+# Ragged gather:
+## The rows of a CSR-style layout (row r holds the entries indptr[r]:indptr[r + 1]) are gathered without a Python
+## loop: the positions of the entries of the wanted rows are one np.repeat of the row starts, shifted by the
+## running offsets, plus an np.arange over all the entries.
+
+# Row-wise top-k:
+## The k best scores of each row are selected with np.argpartition (linear time) and only those k are sorted, with
+## a stable sort, instead of sorting whole rows.
+
+# Pearson correlation from co-rating sums:
+## With n the number of co-ratings of a pair, sx, sy the sums of the two rating vectors over them, sxx, syy the
+## sums of their squares and sxy the sum of their products (all computed as sparse matrix products):
+## corr = (n * sxy - sx * sy) / sqrt((n * sxx - sx^2) * (n * syy - sy^2))
+
+import numpy as np
+
+
+# Positions of the entries of the ranges starts[i]:starts[i] + lengths[i], concatenated
+def gather_ranges(starts, lengths):
+    return np.repeat(starts - np.cumsum(np.concatenate([[0], lengths[:-1]])), lengths) + np.arange(lengths.sum())
+
+
+# Positions of the entries of some rows of a CSR-style layout (row offsets in indptr), and the row lengths
+def gather_rows(indptr, rows):
+    starts, lengths = indptr[rows], indptr[rows + 1] - indptr[rows]
+    return gather_ranges(starts, lengths), lengths
+
+
+# Columns and scores of the k highest scores of each row, by descending score
+def top_k_rows(scores, k):
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def pearson_from_sums(n, sx, sy, sxx, syy, sxy):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corr = (n * sxy - sx * sy) / np.sqrt((n * sxx - sx ** 2) * (n * syy - sy ** 2))
+    # Like corrwith: no correlation from less than two co-ratings or from a constant rating vector
+    corr[(n < 2) | ~np.isfinite(corr)] = np.nan
+    return np.clip(corr, -1, 1)
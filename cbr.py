@@ -19,12 +19,23 @@
 ## links_small.csv: Contains the TMDB and IMDB IDs of a small subset of 9,000 movies of the Full Dataset.
 ## ratings_small.csv: The subset of 100,000 ratings from 700 users on 9,000 movies.
 
+import ast
+import os
+import re
+import time
+import numpy as np
 import pandas as pd
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 500)
 pd.set_option('display.expand_frame_repr', False)
-from sklearn.feature_extraction.text import TfidfVectorizer
+from joblib import Parallel, delayed, effective_n_jobs
+from scipy.sparse import csr_matrix, hstack, issparse, vstack
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer, TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
+from sklearn.random_projection import SparseRandomProjection
+from array_ops import top_k_rows
+from model_store import attach_model, publish_model
 
 #############################
 # Developing Recommendations Based on Movie Overviews
@@ -34,6 +45,11 @@ from sklearn.metrics.pairwise import cosine_similarity
 # 2. Creating Cosine Similarity Matrix
 # 3. Making Recommendations Based on Similarities
 # 4. Preparing the Working Script
+# 5. Persisting the Content Index for Fast Cold Start
+# 6. Recommender Object and Batch Recommendations
+# 7. Incremental Catalogue Updates
+# 8. Approximate Nearest Neighbor Search
+# 9. Multi-Field Content Features from Keywords and Credits
 
 #################################
 # 1. Creating TF-IDF Matrix
@@ -107,6 +123,12 @@ def content_based_recommender(title, cosine_sim, dataframe):
     indices = indices[~indices.index.duplicated(keep='last')]
     # Capture index of title
     movie_index = indices[title]
+    if issparse(cosine_sim):
+        # Top-k neighbor index: the row only holds the stored neighbors, itself excluded
+        row = cosine_sim.getrow(movie_index)
+        order = np.argsort(-row.data, kind="stable")
+        movie_indices = row.indices[order][:10]
+        return dataframe['title'].iloc[movie_indices]
     # Calculating similarity scores by title
     similarity_scores = pd.DataFrame(cosine_sim[movie_index], columns=["score"])
     # Don't bring the top 10 movies except for itself
@@ -122,13 +144,577 @@ content_based_recommender("The Godfather", cosine_sim, df)
 content_based_recommender('The Dark Knight Rises', cosine_sim, df)
 
 
-def calculate_cosine_sim(dataframe):
-    tfidf = TfidfVectorizer(stop_words='english')
-    dataframe['overview'] = dataframe['overview'].fillna('')
-    tfidf_matrix = tfidf.fit_transform(dataframe['overview'])
-    cosine_sim = cosine_similarity(tfidf_matrix, tfidf_matrix)
+# The dense cosine matrix is n x n float64 (about 16 GB for 45k movies) although a recommendation only needs
+# the best few neighbors of one movie. The TF-IDF matrix is processed in row blocks instead and only the top-k
+# neighbors of each movie are kept in a sparse CSR matrix, so memory grows linearly with the catalogue.
+def _block_topk(block, block_start, top_k):
+    # A movie is not its own neighbor
+    rows = np.arange(block.shape[0])
+    block[rows, rows + block_start] = -np.inf
+    top, top_scores = top_k_rows(block, top_k)
+    return top.astype(np.int32), top_scores
+
+
+def _topk_neighbor_rows(tfidf_matrix, start, stop, top_k, block_size):
+    tfidf_matrix_t = tfidf_matrix.T.tocsr()
+    neighbors, scores = [], []
+    for block_start in range(start, stop, block_size):
+        block_stop = min(block_start + block_size, stop)
+        block = (tfidf_matrix[block_start:block_stop] @ tfidf_matrix_t).toarray()
+        block_neighbors, block_scores = _block_topk(block, block_start, top_k)
+        neighbors.append(block_neighbors)
+        scores.append(block_scores)
+    return np.vstack(neighbors), np.vstack(scores)
+
+
+def build_topk_neighbors(tfidf_matrix, top_k=50, block_size=256, n_jobs=-1):
+    tfidf_matrix = normalize(csr_matrix(tfidf_matrix, dtype=np.float32))
+    n_movies = tfidf_matrix.shape[0]
+    top_k = min(top_k, n_movies - 1)
+    # A few row ranges per core so that one slow range doesn't hold up the others
+    n_ranges = min(n_movies, effective_n_jobs(n_jobs) * 4)
+    bounds = np.linspace(0, n_movies, n_ranges + 1, dtype=int)
+    results = Parallel(n_jobs=n_jobs)(delayed(_topk_neighbor_rows)(tfidf_matrix, start, stop, top_k, block_size)
+                                      for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start)
+    neighbors = np.vstack([result[0] for result in results])
+    scores = np.vstack([result[1] for result in results])
+    # Each row keeps its neighbors ordered by descending similarity
+    cosine_sim = csr_matrix((scores.ravel(), neighbors.ravel(), np.arange(0, n_movies * top_k + 1, top_k)),
+                            shape=(n_movies, n_movies))
+    cosine_sim.eliminate_zeros()
+    return cosine_sim
+
+
+def calculate_cosine_sim(dataframe, top_k=50, n_jobs=-1, feature_matrix=None):
+    # feature_matrix replaces the overview TF-IDF, e.g. the combined matrix of build_multi_field_matrix
+    if feature_matrix is None:
+        tfidf = TfidfVectorizer(stop_words='english')
+        dataframe['overview'] = dataframe['overview'].fillna('')
+        feature_matrix = tfidf.fit_transform(dataframe['overview'])
+    cosine_sim = build_topk_neighbors(feature_matrix, top_k=top_k, n_jobs=n_jobs)
     return cosine_sim
 
 
 cosine_sim = calculate_cosine_sim(df)
-content_based_recommender('The Dark Knight Rises', cosine_sim, df)
\ No newline at end of file
+content_based_recommender('The Dark Knight Rises', cosine_sim, df)
+
+
+#################################
+# 5. Persisting the Content Index for Fast Cold Start
+#################################
+
+# Every process used to re-read movies_metadata.csv, refit the TF-IDF vectorizer and recompute the neighbors
+# before serving one request. The fitted vocabulary, the title-to-row mapping and the neighbor lists are published
+# as flat arrays to the shared model store (model_store.py) instead, and attaching memory-maps the files: a worker
+# starts in milliseconds and workers on the same host share the same pages through the OS page cache. A new
+# version is swapped in atomically and the workers pick it up when current_version changes.
+# Strings are stored as fixed-width utf-8 bytes so that they can be memory-mapped and binary searched as well.
+
+def _encode_strings(values):
+    return np.char.encode(np.asarray(values, dtype=str), "utf-8")
+
+
+def _content_index_arrays(tfidf, dataframe, cosine_sim):
+    cosine_sim = csr_matrix(cosine_sim, dtype=np.float32)
+    titles = _encode_strings(dataframe['title'].fillna(''))
+    # Same title lookup as content_based_recommender: the last row wins for duplicated titles
+    indices = pd.Series(np.arange(len(titles), dtype=np.int32), index=titles)
+    indices = indices[~indices.index.duplicated(keep='last')].sort_index()
+    arrays = {"titles": titles,
+              "title_keys": indices.index.values.astype(titles.dtype),
+              "title_rows": indices.values,
+              "terms": _encode_strings(tfidf.get_feature_names_out()),
+              "idf": tfidf.idf_,
+              "indptr": cosine_sim.indptr.astype(np.int64),
+              "indices": cosine_sim.indices.astype(np.int32),
+              "data": cosine_sim.data}
+    meta = {"n_movies": int(cosine_sim.shape[0]), "stop_words": tfidf.stop_words}
+    return arrays, meta
+
+
+def _content_index_from_arrays(index, meta):
+    n_movies = meta["n_movies"]
+    # copy=False keeps the CSR arrays backed by the memory-mapped files
+    index["cosine_sim"] = csr_matrix((index["data"], index["indices"], index["indptr"]),
+                                     shape=(n_movies, n_movies), copy=False)
+    index["meta"] = meta
+    return index
+
+
+def publish_content_index(store_dir, tfidf, dataframe, cosine_sim, name="content_index"):
+    arrays, meta = _content_index_arrays(tfidf, dataframe, cosine_sim)
+    return publish_model(store_dir, name, arrays, meta)
+
+
+def attach_content_index(store_dir, name="content_index"):
+    model = attach_model(store_dir, name)
+    index = _content_index_from_arrays(dict(model["arrays"]), model["meta"])
+    index["version"] = model["version"]
+    return index
+
+
+def load_content_vectorizer(index):
+    # Only needed to vectorize new overviews, so the vocabulary dictionary is built on demand
+    terms = np.char.decode(index["terms"], "utf-8")
+    tfidf = TfidfVectorizer(stop_words=index["meta"]["stop_words"], vocabulary=terms.tolist())
+    tfidf.idf_ = np.asarray(index["idf"])
+    return tfidf
+
+
+def find_title_row(index, title):
+    key = title.encode("utf-8")
+    position = np.searchsorted(index["title_keys"], key)
+    if position == len(index["title_keys"]) or index["title_keys"][position] != key:
+        raise KeyError(title)
+    return int(index["title_rows"][position])
+
+
+def recommend_from_index(title, index, count=10):
+    movie_index = find_title_row(index, title)
+    start, stop = index["indptr"][movie_index], index["indptr"][movie_index + 1]
+    scores = index["data"][start:stop]
+    order = np.argsort(-scores, kind="stable")[:count]
+    titles = np.char.decode(index["titles"][index["indices"][start:stop][order]], "utf-8")
+    return pd.Series(titles, index=index["indices"][start:stop][order], name="title")
+
+
+publish_content_index("models/store", tfidf, df, cosine_sim)
+content_index = attach_content_index("models/store")
+recommend_from_index('The Dark Knight Rises', content_index)
+
+
+#################################
+# 6. Recommender Object and Batch Recommendations
+#################################
+
+# content_based_recommender rebuilds the title lookup, wraps a whole similarity row in a DataFrame and fully sorts
+# it on every call. The recommender object builds the lookup once and takes the top-k with a partial selection
+# (np.argpartition), and recommend_many answers a whole list of titles in one vectorized pass.
+
+class ContentBasedRecommender:
+    def __init__(self, cosine_sim, titles):
+        self.cosine_sim = cosine_sim
+        self.titles = np.asarray(titles, dtype=object)
+        # Same title lookup as content_based_recommender: the last row wins for duplicated titles
+        indices = pd.Series(np.arange(len(self.titles)), index=self.titles)
+        self.indices = indices[~indices.index.duplicated(keep='last')]
+
+    @classmethod
+    def from_index(cls, index):
+        return cls(index["cosine_sim"], np.char.decode(index["titles"], "utf-8"))
+
+    def _movie_indices(self, titles):
+        movie_indices = self.indices.index.get_indexer(titles)
+        if (movie_indices == -1).any():
+            raise KeyError([title for title, i in zip(titles, movie_indices) if i == -1])
+        return self.indices.values[movie_indices]
+
+    def _candidates(self, movie_indices):
+        # Returns one row of candidate scores (and their column ids) per queried movie
+        if issparse(self.cosine_sim):
+            rows = self.cosine_sim[movie_indices]
+            lengths = np.diff(rows.indptr)
+            width = max(int(lengths.max()), 1)
+            scores = np.full((len(movie_indices), width), -np.inf, dtype=np.float32)
+            columns = np.zeros((len(movie_indices), width), dtype=np.int64)
+            row_ids = np.repeat(np.arange(len(movie_indices)), lengths)
+            positions = np.arange(rows.nnz) - np.repeat(rows.indptr[:-1], lengths)
+            scores[row_ids, positions] = rows.data
+            columns[row_ids, positions] = rows.indices
+        else:
+            scores = np.array(self.cosine_sim[movie_indices], dtype=np.float32)
+            columns = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+        # A movie is not recommended for itself
+        scores[columns == movie_indices[:, None]] = -np.inf
+        return scores, columns
+
+    def _top_k(self, movie_indices, k):
+        scores, columns = self._candidates(movie_indices)
+        top, top_scores = top_k_rows(scores, k)
+        return np.take_along_axis(columns, top, axis=1), top_scores
+
+    def recommend(self, title, k=10):
+        movie_indices, scores = self._top_k(self._movie_indices([title]), k)
+        movie_indices = movie_indices[0][np.isfinite(scores[0])]
+        return pd.Series(self.titles[movie_indices], index=movie_indices, name="title")
+
+    def recommend_many(self, titles, k=10, batch_size=1024):
+        titles = list(titles)
+        if not titles:
+            return pd.DataFrame({"title": pd.Series(dtype=str), "rank": pd.Series(dtype=np.int64),
+                                 "recommendation": pd.Series(dtype=str), "score": pd.Series(dtype=np.float32)})
+        movie_indices = self._movie_indices(titles)
+        frames = []
+        for start in range(0, len(titles), batch_size):
+            batch = movie_indices[start:start + batch_size]
+            neighbors, scores = self._top_k(batch, k)
+            found = np.isfinite(scores)
+            frames.append(pd.DataFrame({"title": np.repeat(titles[start:start + batch_size], found.sum(axis=1)),
+                                        "rank": np.nonzero(found)[1] + 1,
+                                        "recommendation": self.titles[neighbors[found]],
+                                        "score": scores[found]}))
+        return pd.concat(frames, ignore_index=True)
+
+
+recommender = ContentBasedRecommender(cosine_sim, df['title'])
+
+recommender.recommend('The Dark Knight Rises')
+
+recommender.recommend_many(["Sherlock Holmes", "The Matrix", "The Godfather"], k=10)
+
+recommender = ContentBasedRecommender.from_index(content_index)
+
+
+#################################
+# 7. Incremental Catalogue Updates
+#################################
+
+# New movies used to require running calculate_cosine_sim again over the whole catalogue, because a refitted
+# TfidfVectorizer changes the vocabulary and every existing vector with it. The hashed index uses a stable feature
+# space instead: HashingVectorizer needs no vocabulary and the idf weights are frozen at fit time, so the vectors of
+# existing movies never change. append_movies then vectorizes only the new overviews, computes the new rows'
+# neighbors and patches only the existing rows whose top-k lists now contain a new movie.
+
+def fit_hashed_content_index(dataframe, top_k=50, n_features=2 ** 20, n_jobs=-1):
+    vectorizer = HashingVectorizer(stop_words='english', n_features=n_features, alternate_sign=False, norm=None)
+    counts = vectorizer.transform(dataframe['overview'].fillna(''))
+    transformer = TfidfTransformer().fit(counts)
+    tfidf_matrix = transformer.transform(counts).astype(np.float32)
+    cosine_sim = build_topk_neighbors(tfidf_matrix, top_k=top_k, n_jobs=n_jobs)
+    return {"vectorizer": vectorizer,
+            "transformer": transformer,
+            "tfidf_matrix": tfidf_matrix,
+            "cosine_sim": cosine_sim,
+            "titles": np.asarray(dataframe['title'], dtype=object),
+            "top_k": top_k}
+
+
+def append_movies(index, new_dataframe, block_size=256):
+    top_k = index["top_k"]
+    n_old = index["tfidf_matrix"].shape[0]
+    counts = index["vectorizer"].transform(new_dataframe['overview'].fillna(''))
+    new_matrix = index["transformer"].transform(counts).astype(np.float32)
+    tfidf_matrix = vstack([index["tfidf_matrix"], new_matrix], format="csr")
+    n_movies = tfidf_matrix.shape[0]
+    top_k_new = min(top_k, n_movies - 1)
+
+    # The k-th best score of each existing row: a new movie has to beat it to enter that row's top-k
+    old_sim = index["cosine_sim"]
+    lengths = np.diff(old_sim.indptr)
+    thresholds = np.zeros(n_old, dtype=np.float32)
+    full = lengths >= top_k
+    thresholds[full] = old_sim.data[old_sim.indptr[1:][full] - 1]
+
+    tfidf_matrix_t = tfidf_matrix.T.tocsr()
+    new_rows, new_neighbors, new_scores = [], [], []
+    patch_rows, patch_neighbors, patch_scores = [], [], []
+    for block_start in range(n_old, n_movies, block_size):
+        block_stop = min(block_start + block_size, n_movies)
+        block = (tfidf_matrix[block_start:block_stop] @ tfidf_matrix_t).toarray()
+        # Existing movies for which a new movie enters the top-k
+        movies, rows = np.nonzero((block[:, :n_old] > thresholds) & (block[:, :n_old] > 0))
+        patch_rows.append(rows)
+        patch_neighbors.append(movies + block_start)
+        patch_scores.append(block[movies, rows])
+        neighbors, scores = _block_topk(block, block_start, top_k_new)
+        new_rows.append(np.repeat(np.arange(block_start, block_stop), top_k_new))
+        new_neighbors.append(neighbors.ravel())
+        new_scores.append(scores.ravel())
+
+    # Merge the patches into the affected rows and cut them back to top-k
+    patch_rows = np.concatenate(patch_rows)
+    affected = np.unique(patch_rows)
+    old_rows = np.repeat(np.arange(n_old), lengths)
+    is_affected = np.zeros(n_old, dtype=bool)
+    is_affected[affected] = True
+    in_affected = is_affected[old_rows]
+    rows = np.concatenate([old_rows[in_affected], patch_rows])
+    neighbors = np.concatenate([old_sim.indices[in_affected]] + patch_neighbors)
+    scores = np.concatenate([old_sim.data[in_affected]] + patch_scores)
+    order = np.lexsort((-scores, rows))
+    rows, neighbors, scores = rows[order], neighbors[order], scores[order]
+    group_starts = np.searchsorted(rows, rows, side="left")
+    keep = np.arange(len(rows)) - group_starts < top_k
+
+    # Unaffected rows keep their entries, in order; the stable sort by row only interleaves the patched rows
+    rows = np.concatenate([old_rows[~in_affected], rows[keep]] + new_rows)
+    neighbors = np.concatenate([old_sim.indices[~in_affected], neighbors[keep]] + new_neighbors)
+    scores = np.concatenate([old_sim.data[~in_affected], scores[keep]] + new_scores)
+    order = np.argsort(rows, kind="stable")
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_movies))])
+    cosine_sim = csr_matrix((scores[order], neighbors[order].astype(np.int32), indptr), shape=(n_movies, n_movies))
+    cosine_sim.eliminate_zeros()
+
+    index["tfidf_matrix"] = tfidf_matrix
+    index["cosine_sim"] = cosine_sim
+    index["titles"] = np.concatenate([index["titles"], np.asarray(new_dataframe['title'], dtype=object)])
+    return index
+
+
+hashed_index = fit_hashed_content_index(df.iloc[:-100])
+
+hashed_index = append_movies(hashed_index, df.iloc[-100:])
+
+recommender = ContentBasedRecommender(hashed_index["cosine_sim"], hashed_index["titles"])
+recommender.recommend('The Dark Knight Rises')
+
+
+#################################
+# 8. Approximate Nearest Neighbor Search
+#################################
+
+# Even the blocked top-k build compares every movie with every other one, O(n^2) in the catalogue size.
+# Search backends are pluggable objects with fit(tfidf_matrix) and kneighbors(query_matrix, k), which returns the
+# neighbor ids and cosine scores (padded with -1 / -inf). ExactCosineSearch is the brute force reference and
+# RandomProjectionLSH hashes the TF-IDF vectors with signed random projections (SimHash) into n_tables hash tables
+# and only scores the movies that share a bucket with the query.
+# Recall/latency knobs: more n_tables and n_probes (the number of least confident bits flipped per table at query
+# time) give a higher recall for more candidates to score; more n_bits gives smaller buckets.
+# evaluate_recall measures the recall against the exact cosine_similarity result on a sample of movies.
+
+class ExactCosineSearch:
+    def __init__(self, block_size=256):
+        self.block_size = block_size
+
+    def fit(self, tfidf_matrix):
+        self.tfidf_matrix = normalize(csr_matrix(tfidf_matrix, dtype=np.float32))
+        self.tfidf_matrix_t = self.tfidf_matrix.T.tocsr()
+        return self
+
+    def kneighbors(self, query_matrix, k=10):
+        query_matrix = normalize(csr_matrix(query_matrix, dtype=np.float32))
+        neighbors, scores = [], []
+        for start in range(0, query_matrix.shape[0], self.block_size):
+            block = (query_matrix[start:start + self.block_size] @ self.tfidf_matrix_t).toarray()
+            block_neighbors, block_scores = top_k_rows(block, k)
+            neighbors.append(block_neighbors)
+            scores.append(block_scores)
+        return np.vstack(neighbors), np.vstack(scores)
+
+
+class RandomProjectionLSH:
+    def __init__(self, n_tables=16, n_bits=12, n_probes=4, random_state=42):
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.n_probes = n_probes
+        self.random_state = random_state
+
+    def _project(self, matrix):
+        projections = self.projection.transform(matrix)
+        if issparse(projections):
+            projections = projections.toarray()
+        return projections.reshape(matrix.shape[0], self.n_tables, self.n_bits)
+
+    def _keys(self, projections):
+        weights = np.left_shift(np.uint64(1), np.arange(self.n_bits, dtype=np.uint64))
+        return ((projections > 0).astype(np.uint64) * weights).sum(axis=2, dtype=np.uint64)
+
+    def fit(self, tfidf_matrix):
+        self.tfidf_matrix = normalize(csr_matrix(tfidf_matrix, dtype=np.float32))
+        # Sparse projections keep the projection matrix small even for a 2**20 hashed feature space
+        self.projection = SparseRandomProjection(n_components=self.n_tables * self.n_bits, dense_output=True,
+                                                 random_state=self.random_state).fit(self.tfidf_matrix)
+        keys = self._keys(self._project(self.tfidf_matrix))
+        # One sorted key array per table; a bucket is the range of equal keys
+        self.orders = np.argsort(keys, axis=0, kind="stable")
+        self.sorted_keys = np.take_along_axis(keys, self.orders, axis=0)
+        return self
+
+    def _probe_keys(self, projections):
+        keys = self._keys(projections)
+        if self.n_probes == 0:
+            return keys[:, :, None]
+        # Multi-probe: also visit the buckets reached by flipping the bits closest to the hyperplanes
+        weakest = np.argsort(np.abs(projections), axis=2)[:, :, :self.n_probes].astype(np.uint64)
+        flipped = keys[:, :, None] ^ np.left_shift(np.uint64(1), weakest)
+        return np.concatenate([keys[:, :, None], flipped], axis=2)
+
+    def kneighbors(self, query_matrix, k=10):
+        query_matrix = normalize(csr_matrix(query_matrix, dtype=np.float32))
+        probe_keys = self._probe_keys(self._project(query_matrix))
+        lefts = np.empty(probe_keys.shape, dtype=np.int64)
+        rights = np.empty(probe_keys.shape, dtype=np.int64)
+        for table in range(self.n_tables):
+            lefts[:, table] = np.searchsorted(self.sorted_keys[:, table], probe_keys[:, table], side="left")
+            rights[:, table] = np.searchsorted(self.sorted_keys[:, table], probe_keys[:, table], side="right")
+        neighbors = np.full((query_matrix.shape[0], k), -1, dtype=np.int64)
+        scores = np.full((query_matrix.shape[0], k), -np.inf, dtype=np.float32)
+        for i in range(query_matrix.shape[0]):
+            candidates = np.unique(np.concatenate([self.orders[left:right, table]
+                                                   for table in range(self.n_tables)
+                                                   for left, right in zip(lefts[i, table], rights[i, table])
+                                                   if right > left] or [np.empty(0, dtype=np.int64)]))
+            if len(candidates) == 0:
+                continue
+            candidate_scores = (self.tfidf_matrix[candidates] @ query_matrix[i].T).toarray().ravel()
+            top = np.argsort(-candidate_scores, kind="stable")[:k]
+            neighbors[i, :len(top)] = candidates[top]
+            scores[i, :len(top)] = candidate_scores[top]
+        return neighbors, scores
+
+
+def build_approximate_neighbors(tfidf_matrix, search, top_k=50, batch_size=1024):
+    search.fit(tfidf_matrix)
+    n_movies = tfidf_matrix.shape[0]
+    rows, neighbors, scores = [], [], []
+    for start in range(0, n_movies, batch_size):
+        stop = min(start + batch_size, n_movies)
+        # One extra neighbor because a movie usually finds itself
+        batch_neighbors, batch_scores = search.kneighbors(tfidf_matrix[start:stop], top_k + 1)
+        batch_rows = np.broadcast_to(np.arange(start, stop)[:, None], batch_neighbors.shape)
+        keep = (batch_neighbors != batch_rows) & (batch_neighbors >= 0)
+        # Keep at most top_k per row after dropping the movie itself
+        keep &= np.cumsum(keep, axis=1) <= top_k
+        rows.append(batch_rows[keep])
+        neighbors.append(batch_neighbors[keep])
+        scores.append(batch_scores[keep])
+    rows, neighbors, scores = np.concatenate(rows), np.concatenate(neighbors), np.concatenate(scores)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_movies))])
+    cosine_sim = csr_matrix((scores.astype(np.float32), neighbors.astype(np.int32), indptr),
+                            shape=(n_movies, n_movies))
+    cosine_sim.eliminate_zeros()
+    return cosine_sim
+
+
+def evaluate_recall(search, tfidf_matrix, k=10, sample_size=200, random_state=42):
+    rng = np.random.default_rng(random_state)
+    sample = rng.choice(tfidf_matrix.shape[0], size=min(sample_size, tfidf_matrix.shape[0]), replace=False)
+    exact = cosine_similarity(tfidf_matrix[sample], tfidf_matrix)
+    exact[np.arange(len(sample)), sample] = -np.inf
+    # The k-th exact score; ties with it count as hits
+    kth_scores = -np.partition(-exact, k - 1, axis=1)[:, k - 1]
+    start = time.perf_counter()
+    neighbors, scores = search.kneighbors(tfidf_matrix[sample], k + 1)
+    elapsed = time.perf_counter() - start
+    hits = np.array([np.sum(row_scores[(row_neighbors != movie) & (row_neighbors >= 0)][:k] >= kth - 1e-6)
+                     for movie, row_neighbors, row_scores, kth in zip(sample, neighbors, scores, kth_scores)])
+    return {"recall": float(np.mean(hits / k)),
+            "ms_per_query": 1000 * elapsed / len(sample)}
+
+
+tfidf_matrix = tfidf.transform(df['overview'])
+
+pd.DataFrame([dict(n_probes=n_probes,
+                   **evaluate_recall(RandomProjectionLSH(n_probes=n_probes).fit(tfidf_matrix), tfidf_matrix))
+              for n_probes in [0, 2, 4]])
+
+approximate_sim = build_approximate_neighbors(tfidf_matrix, RandomProjectionLSH())
+ContentBasedRecommender(approximate_sim, df['title']).recommend('The Dark Knight Rises')
+
+
+#################################
+# 9. Multi-Field Content Features from Keywords and Credits
+#################################
+
+# keywords.csv and credits.csv hold stringified JSON (python literals) that is notoriously slow to parse row by row
+# with ast.literal_eval. The files are streamed in chunks and the chunks are parsed in a process pool; only the
+# quoted names are extracted with regular expressions and literal_eval'ed. The parsed keyword, cast and director
+# tokens are cached in a columnar .npz file (one vocabulary, token codes and row offsets per field), keyed on the
+# source files' mtime and size, so later runs skip the parse entirely.
+# build_multi_field_matrix combines the overview TF-IDF with the token fields into one weighted sparse matrix
+# that can be passed to calculate_cosine_sim as feature_matrix.
+
+FEATURE_FIELDS = ["keywords", "cast", "director"]
+
+NAME_PATTERN = re.compile(r"""'name': ('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")""")
+DIRECTOR_PATTERN = re.compile(r"""'job': 'Director', 'name': ('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")""")
+
+
+def _name_tokens(literals):
+    # "Tom Hanks" -> "tomhanks", so that first names shared by different people don't match
+    return [ast.literal_eval(literal).lower().replace(" ", "") for literal in literals]
+
+
+def _parse_feature_chunk(chunk, n_cast):
+    parsed = {"id": pd.to_numeric(chunk["id"], errors="coerce").values}
+    fields = {}
+    if "keywords" in chunk:
+        fields["keywords"] = [_name_tokens(NAME_PATTERN.findall(text)) for text in chunk["keywords"].fillna("")]
+    if "cast" in chunk:
+        fields["cast"] = [_name_tokens(NAME_PATTERN.findall(text)[:n_cast]) for text in chunk["cast"].fillna("")]
+    if "crew" in chunk:
+        fields["director"] = [_name_tokens(DIRECTOR_PATTERN.findall(text)) for text in chunk["crew"].fillna("")]
+    for field, tokens in fields.items():
+        parsed[field] = ([token for row in tokens for token in row], np.array([len(row) for row in tokens]))
+    return parsed
+
+
+def _source_key(paths):
+    return np.array([[os.stat(path).st_mtime_ns, os.stat(path).st_size] for path in paths], dtype=np.int64)
+
+
+def parse_content_features(keywords_path, credits_path, chunksize=5000, n_cast=3, n_jobs=-1):
+    readers = [pd.read_csv(keywords_path, usecols=["id", "keywords"], chunksize=chunksize),
+               pd.read_csv(credits_path, usecols=["id", "cast", "crew"], chunksize=chunksize)]
+    chunks = (chunk for reader in readers for chunk in reader)
+    parsed = Parallel(n_jobs=n_jobs, return_as="generator")(delayed(_parse_feature_chunk)(chunk, n_cast)
+                                                            for chunk in chunks)
+    ids, tokens, lengths = {}, {}, {}
+    for part in parsed:
+        for field in FEATURE_FIELDS:
+            if field in part:
+                ids.setdefault(field, []).append(part["id"])
+                tokens.setdefault(field, []).extend(part[field][0])
+                lengths.setdefault(field, []).append(part[field][1])
+
+    # Rows are aligned on the sorted union of movie ids, the first row wins for duplicated ids
+    all_ids = np.unique(np.concatenate([np.concatenate(field_ids) for field_ids in ids.values()]))
+    all_ids = all_ids[~np.isnan(all_ids)].astype(np.int64)
+    features = {"id": all_ids}
+    for field in FEATURE_FIELDS:
+        field_ids = pd.Series(np.concatenate(ids[field]))
+        field_lengths = np.concatenate(lengths[field])
+        codes, vocabulary = pd.factorize(pd.Series(tokens[field], dtype=object))
+        rows = csr_matrix((np.ones(len(codes), dtype=np.float32), codes,
+                           np.concatenate([[0], np.cumsum(field_lengths)])),
+                          shape=(len(field_ids), len(vocabulary)))
+        first = np.nonzero(field_ids.notna().values & ~field_ids.duplicated().values)[0]
+        first = first[np.argsort(field_ids.values[first], kind="stable")]
+        rows = rows[first]
+        aligned_lengths = np.zeros(len(all_ids), dtype=np.int64)
+        aligned_lengths[np.searchsorted(all_ids, field_ids.values[first])] = np.diff(rows.indptr)
+        features[field + "_vocabulary"] = np.asarray(vocabulary, dtype=str)
+        features[field + "_codes"] = rows.indices.astype(np.int32)
+        features[field + "_offsets"] = np.concatenate([[0], np.cumsum(aligned_lengths)])
+    return features
+
+
+def load_content_features(keywords_path="datasets/the_movies_dataset/keywords.csv",
+                          credits_path="datasets/the_movies_dataset/credits.csv",
+                          cache_path="datasets/the_movies_dataset/content_features.npz", **kwargs):
+    source_key = _source_key([keywords_path, credits_path])
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            if np.array_equal(cache["source_key"], source_key):
+                return {name: cache[name] for name in cache.files if name != "source_key"}
+    features = parse_content_features(keywords_path, credits_path, **kwargs)
+    np.savez(cache_path, source_key=source_key, **features)
+    return features
+
+
+def build_multi_field_matrix(dataframe, features, weights=None, tfidf_matrix=None):
+    weights = {"overview": 1.0, "keywords": 1.0, "cast": 0.5, "director": 0.5, **(weights or {})}
+    if tfidf_matrix is None:
+        tfidf_matrix = TfidfVectorizer(stop_words='english').fit_transform(dataframe['overview'].fillna(''))
+    # movies_metadata ids are strings with a few malformed values; unknown ids get empty token rows
+    movie_ids = pd.to_numeric(dataframe['id'], errors="coerce").values
+    positions = np.searchsorted(features["id"], movie_ids)
+    positions = np.minimum(positions, len(features["id"]) - 1)
+    found = features["id"][positions] == movie_ids
+    blocks = [normalize(csr_matrix(tfidf_matrix, dtype=np.float32)) * weights["overview"]]
+    for field in FEATURE_FIELDS:
+        offsets = features[field + "_offsets"]
+        field_matrix = csr_matrix((np.ones(len(features[field + "_codes"]), dtype=np.float32),
+                                   features[field + "_codes"], offsets),
+                                  shape=(len(offsets) - 1, len(features[field + "_vocabulary"])))
+        field_matrix = field_matrix[positions].multiply(found[:, None]).tocsr()
+        blocks.append(normalize(TfidfTransformer().fit_transform(field_matrix)) * weights[field])
+    return normalize(hstack(blocks, format="csr")).astype(np.float32)
+
+
+content_features = load_content_features()
+
+feature_matrix = build_multi_field_matrix(df, content_features, tfidf_matrix=tfidf_matrix)
+
+cosine_sim = calculate_cosine_sim(df, feature_matrix=feature_matrix)
+ContentBasedRecommender(cosine_sim, df['title']).recommend('The Dark Knight Rises')
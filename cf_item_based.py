@@ -28,15 +28,23 @@ from kiwisolver import Variable
 # Step 2: Creating the User Movie Df
 # Step 3: Making Item-Based Movie Recommendations
 # Step 4: Preparing the Working Script
+# Step 5: Precomputed Item-Item Similarity Model
+# Step 6: Sparse User Movie Matrix
+# Step 7: Recommendations from a User's Whole History
+# Step 8: Incremental Updates as New Ratings Stream In
 
 ######################################
 # Step 1: Preparing the Dataset
 ######################################
+import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix
+from array_ops import gather_ranges, pearson_from_sums, top_k_rows
+from movielens import create_user_movie_matrix, load_movies, load_ratings, user_movie_matrix_from_df
 pd.set_option('display.max_columns', 500)
 
-movie = pd.read_csv('datasets/movie_lens_dataset/movie.csv')
-rating = pd.read_csv('datasets/movie_lens_dataset/rating.csv')
+movie = load_movies()
+rating = load_ratings()
 
 df = movie.merge(rating, how="left", on="movieId")
 df.head()
@@ -97,8 +105,8 @@ check_film("Insomnia", user_movie_df)
 ## Related tasks are grouped under a clear name, which simplifies maintenance and increases testability.
 def create_user_movie_df():
     import pandas as pd
-    movie = pd.read_csv('datasets/movie_lens_dataset/movie.csv')
-    rating = pd.read_csv('datasets/movie_lens_dataset/rating.csv')
+    movie = load_movies()
+    rating = load_ratings()
     df = movie.merge(rating, how="left", on="movieId")
     comment_counts = df["title"].value_counts().reset_index()
     comment_counts.columns = ["title", "count"]
@@ -111,6 +119,8 @@ user_movie_df = create_user_movie_df()
 
 
 def item_based_recommender(movie_name, user_movie_df):
+    if isinstance(user_movie_df, dict):
+        return sparse_item_based_recommender(movie_name, user_movie_df)
     movie_name = user_movie_df[movie_name]
     return user_movie_df.corrwith(movie_name).sort_values(ascending=False).head(10)
 
@@ -119,3 +129,268 @@ item_based_recommender("Matrix, The (1999)", user_movie_df)
 movie_name = pd.Series(user_movie_df.columns).sample(1).values[0]
 
 item_based_recommender(movie_name, user_movie_df)
+
+
+######################################
+# Step 5: Precomputed Item-Item Similarity Model
+######################################
+# item_based_recommender runs corrwith, a Pearson correlation of one column against all columns over all users, on
+# every query. fit_item_similarity computes the whole item-item Pearson matrix once and keeps the top_n neighbors
+# of each item, so a query is a lookup.
+# Missing ratings are handled pairwise-complete like corrwith: the correlation of items i and j only uses the users
+# who rated both. With R the ratings and M the rated mask (users x items), the co-rating statistics of all pairs
+# are sparse matrix products:
+## n = M'M (co-rating counts), sx = R'M (sums of x over co-raters), sxx = (R*R)'M, sxy = R'R
+## corr = (n * sxy - sx * sy) / sqrt((n * sxx - sx^2) * (n * syy - sy^2)), with sy = sx' and syy = sxx'
+
+def item_pair_statistics(ratings, rated, dense=True):
+    stats = {"n": rated.T @ rated,
+             "sx": ratings.T @ rated,
+             "sxx": ratings.multiply(ratings).T @ rated,
+             "sxy": ratings.T @ ratings}
+    return {name: stat.toarray() for name, stat in stats.items()} if dense else stats
+
+
+def pearson_from_statistics(stats, items=None):
+    # items limits the computation to the rows of some items
+    items = slice(None) if items is None else items
+    n, sx, sxx, sxy = stats["n"][items], stats["sx"][items], stats["sxx"][items], stats["sxy"][items]
+    sy, syy = stats["sx"][:, items].T, stats["sxx"][:, items].T
+    return pearson_from_sums(n, sx, sy, sxx, syy, sxy)
+
+
+def top_n_neighbors(corr, top_n):
+    neighbors, top_scores = top_k_rows(np.where(np.isnan(corr), -np.inf, corr), top_n)
+    return neighbors.astype(np.int32), top_scores.astype(np.float32)
+
+
+def rated_mask(ratings):
+    rated = ratings.copy()
+    rated.data[:] = 1
+    return rated
+
+
+def fit_item_similarity(user_movie_df, top_n=50, keep_statistics=False):
+    # Runs on the sparse user movie matrix, a user_movie_df is converted first
+    if isinstance(user_movie_df, pd.DataFrame):
+        user_movie_df = user_movie_matrix_from_df(user_movie_df)
+    ratings = user_movie_df["ratings"].astype(np.float64)
+    stats = item_pair_statistics(ratings, rated_mask(ratings))
+    neighbors, scores = top_n_neighbors(pearson_from_statistics(stats), top_n)
+    item_model = {"titles": user_movie_df["titles"],
+                  "title_index": user_movie_df["title_index"],
+                  "neighbors": neighbors,
+                  "scores": scores}
+    if keep_statistics:
+        # Needed by update_item_similarity
+        item_model.update({"statistics": stats,
+                           "rating_rows": rating_row_store(ratings),
+                           "user_ids": user_movie_df["user_ids"],
+                           "user_index": user_movie_df["user_index"],
+                           "movie_index": pd.Index(user_movie_df.get("movie_ids", [])),
+                           "movie_cols": user_movie_df.get("movie_cols", np.empty(0, dtype=np.int32))})
+    return item_model
+
+
+def item_similarity_recommender(movie_name, item_model, count=10):
+    # Same output as item_based_recommender (the movie itself included), read from the precomputed neighbors
+    item = item_model["title_index"].get_loc(movie_name)
+    scores = item_model["scores"][item, :count]
+    neighbors = item_model["neighbors"][item, :count][np.isfinite(scores)]
+    return pd.Series(scores[np.isfinite(scores)], index=item_model["titles"][neighbors])
+
+
+item_model = fit_item_similarity(user_movie_df)
+
+item_similarity_recommender("Matrix, The (1999)", item_model)
+
+
+######################################
+# Step 6: Sparse User Movie Matrix
+######################################
+# create_user_movie_matrix (movielens.py) holds the user movie table as a CSR matrix of float32 ratings instead of
+# a dense, mostly NaN float64 DataFrame. item_based_recommender and fit_item_similarity run on it directly:
+# corrwith over one column becomes a few sparse matrix-vector products over the users who rated the movie.
+
+def sparse_item_based_recommender(movie_name, user_movie_matrix, count=10):
+    ratings = user_movie_matrix["ratings"]
+    item = user_movie_matrix["title_index"].get_loc(movie_name)
+    column = ratings[:, item].tocoo()
+    # Only the users who rated the movie can contribute to a correlation with it
+    raters = ratings[column.row].astype(np.float64)
+    x = column.data.astype(np.float64)
+    rated = raters.copy()
+    rated.data[:] = 1
+    n = np.asarray(rated.sum(axis=0)).ravel()
+    sx, sxx = rated.T @ x, rated.T @ x ** 2
+    sy = np.asarray(raters.sum(axis=0)).ravel()
+    syy = np.asarray(raters.multiply(raters).sum(axis=0)).ravel()
+    sxy = raters.T @ x
+    corr = pd.Series(pearson_from_sums(n, sx, sy, sxx, syy, sxy), index=user_movie_matrix["titles"])
+    return corr.sort_values(ascending=False).head(count)
+
+
+user_movie_matrix = create_user_movie_matrix()
+
+item_based_recommender("Matrix, The (1999)", user_movie_matrix)
+
+item_model = fit_item_similarity(user_movie_matrix)
+
+
+######################################
+# Step 7: Recommendations from a User's Whole History
+######################################
+# Recommending from a whole watch history used to mean one item_based_recommender call per watched movie and
+# merging the Series by hand. The item-item similarity of the fitted model is held as a sparse matrix S (item x its
+# top_n neighbors, positive correlations only) and all candidates are scored in one sparse matrix-vector product:
+## score = S' r, where r holds the user's ratings of the watched movies,
+# so a candidate scores high when it is close to many movies the user rated highly.
+
+def item_similarity_matrix(item_model):
+    n_items, top_n = item_model["neighbors"].shape
+    rows = np.repeat(np.arange(n_items), top_n)
+    neighbors = item_model["neighbors"].ravel()
+    scores = item_model["scores"].ravel()
+    # The movie itself and the negative (or missing) correlations are left out
+    keep = (neighbors != rows) & (scores > 0)
+    return csr_matrix((scores[keep], (rows[keep], neighbors[keep])), shape=(n_items, n_items))
+
+
+def user_history(user_id, user_movie_matrix):
+    row = user_movie_matrix["ratings"][user_movie_matrix["user_index"].get_loc(user_id)]
+    return pd.Series(row.data, index=user_movie_matrix["titles"][row.indices])
+
+
+def history_based_recommender(history, item_model, count=10):
+    if "similarity" not in item_model:
+        item_model["similarity"] = item_similarity_matrix(item_model)
+    items = item_model["title_index"].get_indexer(history.index)
+    watched, ratings = items[items >= 0], history.values[items >= 0]
+    scores = item_model["similarity"][watched].T @ ratings
+    # Already watched movies are not recommended
+    scores[watched] = -np.inf
+    count = min(count, len(scores))
+    top = np.argpartition(-scores, count - 1)[:count]
+    top = top[np.argsort(-scores[top], kind="stable")]
+    top = top[scores[top] > 0]
+    return pd.Series(scores[top], index=item_model["titles"][top])
+
+
+random_user = int(pd.Series(user_movie_matrix["user_ids"]).sample(1).values[0])
+history_based_recommender(user_history(random_user, user_movie_matrix), item_model)
+
+
+######################################
+# Step 8: Incremental Updates as New Ratings Stream In
+######################################
+# A new rating used to mean rebuilding the user movie df and redoing all the correlations. With keep_statistics=True
+# the model keeps the co-rating statistics of every item pair (counts, sums, sums of squares and cross-products,
+# see Step 5) and the ratings. A batch of (userId, movieId, rating) events only changes the statistics of the pairs
+# co-rated by the users in the batch:
+## delta = statistics(new rows of those users) - statistics(old rows of those users)
+# and only the neighbor lists of the items in a changed pair are recomputed.
+# The ratings are kept in a row store instead of a CSR matrix, where replacing some rows rewrites all the entries:
+## starts, lengths     - row r holds the entries starts[r]:starts[r] + lengths[r] of indices (items) and data
+## size                - used length of indices / data, the arrays have spare capacity behind it
+# The new rows of a batch are appended at the end and the old ones left as dead entries, so a batch costs its own
+# entries only. The arrays are compacted when the dead entries outnumber the live ones, and grown by doubling.
+# A new rating of an already rated movie replaces the old one; events for movies outside the model (rare movies)
+# are ignored. The events can carry a title column instead of movieId.
+
+def rating_row_store(ratings):
+    return {"starts": ratings.indptr[:-1].astype(np.int64),
+            "lengths": np.diff(ratings.indptr).astype(np.int64),
+            "indices": ratings.indices.astype(np.int32),
+            "data": ratings.data.astype(np.float64),
+            "size": ratings.nnz,
+            "n_items": ratings.shape[1]}
+
+
+def _store_rows(store, rows):
+    # CSR matrix of some rows of the store
+    lengths = store["lengths"][rows]
+    positions = gather_ranges(store["starts"][rows], lengths)
+    return csr_matrix((store["data"][positions], store["indices"][positions],
+                       np.concatenate([[0], np.cumsum(lengths)])), shape=(len(rows), store["n_items"]))
+
+
+def _replace_store_rows(store, rows, new_rows):
+    live = int(store["lengths"].sum())
+    if store["size"] + new_rows.nnz > len(store["data"]):
+        if store["size"] - live > live:
+            positions = gather_ranges(store["starts"], store["lengths"])
+            store["indices"], store["data"] = store["indices"][positions], store["data"][positions]
+            store["starts"] = np.cumsum(store["lengths"]) - store["lengths"]
+            store["size"] = live
+        capacity = max(2 * len(store["data"]), store["size"] + new_rows.nnz)
+        store["indices"] = np.resize(store["indices"], capacity)
+        store["data"] = np.resize(store["data"], capacity)
+    end = store["size"] + new_rows.nnz
+    store["indices"][store["size"]:end] = new_rows.indices
+    store["data"][store["size"]:end] = new_rows.data
+    store["starts"][rows] = store["size"] + new_rows.indptr[:-1]
+    store["lengths"][rows] = np.diff(new_rows.indptr)
+    store["size"] = end
+
+
+def update_item_similarity(item_model, events):
+    store = item_model["rating_rows"]
+    n_items = store["n_items"]
+    if "title" in events:
+        items = item_model["title_index"].get_indexer(events["title"])
+    else:
+        if len(item_model["movie_index"]) == 0:
+            # A model fitted on a user_movie_df knows the titles but not their movieIds
+            raise ValueError("movieId events need a model fitted on create_user_movie_matrix, send title events "
+                             "to a model fitted on a user_movie_df")
+        positions = item_model["movie_index"].get_indexer(events["movieId"])
+        items = np.full(len(positions), -1)
+        items[positions >= 0] = item_model["movie_cols"][positions[positions >= 0]]
+    events = events.assign(item=items)
+    events = events[events["item"] >= 0].drop_duplicates(["userId", "item"], keep="last")
+
+    # New users get empty rows first
+    new_users = pd.Index(events["userId"].unique()).difference(item_model["user_index"])
+    if len(new_users):
+        item_model["user_ids"] = np.concatenate([item_model["user_ids"], new_users.values.astype(np.int32)])
+        item_model["user_index"] = pd.Index(item_model["user_ids"])
+        store["starts"] = np.concatenate([store["starts"], np.zeros(len(new_users), dtype=np.int64)])
+        store["lengths"] = np.concatenate([store["lengths"], np.zeros(len(new_users), dtype=np.int64)])
+    rows = item_model["user_index"].get_indexer(events["userId"])
+    users = np.unique(rows)
+    local_rows = np.searchsorted(users, rows)
+
+    # Old and new rating rows of the users in the batch
+    old = _store_rows(store, users).tocoo()
+    replaced = np.isin(old.row * n_items + old.col, local_rows * n_items + events["item"].values)
+    new = csr_matrix((np.concatenate([old.data[~replaced], events["rating"].values.astype(np.float64)]),
+                      (np.concatenate([old.row[~replaced], local_rows]),
+                       np.concatenate([old.col[~replaced], events["item"].values]))),
+                     shape=(len(users), n_items))
+    old = old.tocsr()
+    new_stats = item_pair_statistics(new, rated_mask(new), dense=False)
+    old_stats = item_pair_statistics(old, rated_mask(old), dense=False)
+    changed = []
+    for name, stat in item_model["statistics"].items():
+        delta = (new_stats[name] - old_stats[name]).tocoo()
+        stat[delta.row, delta.col] += delta.data
+        changed.extend([delta.row, delta.col])
+    changed = np.unique(np.concatenate(changed))
+
+    # Refresh the neighbor lists of the changed items only
+    if len(changed):
+        neighbors, scores = top_n_neighbors(pearson_from_statistics(item_model["statistics"], changed),
+                                            item_model["neighbors"].shape[1])
+        item_model["neighbors"][changed] = neighbors
+        item_model["scores"][changed] = scores
+        item_model.pop("similarity", None)
+
+    # Replace the rows of the users in the batch
+    _replace_store_rows(store, users, new)
+    return changed
+
+
+item_model = fit_item_similarity(user_movie_matrix, keep_statistics=True)
+
+new_ratings = pd.DataFrame({"userId": [1, 1, 138494], "movieId": [2571, 356, 2571], "rating": [5.0, 4.0, 4.5]})
+update_item_similarity(item_model, new_ratings)
@@ -30,8 +30,21 @@
 ## Step 4: Determining the Users with the Most Similar Behavior to the User to Be Recommended
 ## Step 5: Calculating the Weighted Average Recommendation Score
 ## Step 6: Functionalization of the Study
-
+## Step 7: Running on the Sparse User Movie Matrix
+## Step 8: Keeping the Ratings Resident
+## Step 9: Batch Recommendations for All Users
+## Step 10: Persisted User-User kNN Graph
+
+import hashlib
+import json
+import os
+import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
+from scipy.sparse import csc_matrix, csr_matrix
+from array_ops import gather_rows, pearson_from_sums, top_k_rows
+from model_store import attach_model, publish_model
+from movielens import create_user_movie_matrix, load_movies, load_ratings
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 500)
 pd.set_option('display.expand_frame_repr', False)
@@ -42,8 +55,8 @@ pd.set_option('display.expand_frame_repr', False)
 
 def create_user_movie_df():
     import pandas as pd
-    movie = pd.read_csv('datasets/movie_lens_dataset/movie.csv')
-    rating = pd.read_csv('datasets/movie_lens_dataset/rating.csv')
+    movie = load_movies()
+    rating = load_ratings()
     df = movie.merge(rating, how="left", on="movieId")
     comment_counts = df["title"].value_counts().reset_index()
     comment_counts.columns = ["title", "count"]
@@ -127,7 +140,7 @@ top_users = top_users.sort_values(by='corr', ascending=False)
 top_users.rename(columns={"user_id_2": "userId"}, inplace=True)
 
 
-rating = pd.read_csv('datasets/movie_lens_dataset/rating.csv')
+rating = load_ratings()
 top_users_ratings = top_users.merge(rating[["userId", "movieId", "rating"]], how='inner')
 
 top_users_ratings = top_users_ratings[top_users_ratings["userId"] != random_user]
@@ -149,7 +162,7 @@ recommendation_df[recommendation_df["weighted_rating"] > 3.5]
 
 movies_to_be_recommend = recommendation_df[recommendation_df["weighted_rating"] > 3.5].sort_values("weighted_rating", ascending=False)
 
-movie = pd.read_csv('datasets/movie_lens_dataset/movie.csv')
+movie = load_movies()
 movies_to_be_recommend.merge(movie[["movieId", "title"]])
 
 
@@ -160,8 +173,8 @@ movies_to_be_recommend.merge(movie[["movieId", "title"]])
 
 def create_user_movie_df():
     import pandas as pd
-    movie = pd.read_csv('datasets/movie_lens_dataset/movie.csv')
-    rating = pd.read_csv('datasets/movie_lens_dataset/rating.csv')
+    movie = load_movies()
+    rating = load_ratings()
     df = movie.merge(rating, how="left", on="movieId")
     comment_counts = df["title"].value_counts().reset_index()
     comment_counts.columns = ["title", "count"]
@@ -176,34 +189,76 @@ user_movie_df = create_user_movie_df()
 # users_same_movies = user_movie_count[user_movie_count["movie_count"] > perc]["userId"]
 
 
+# Only the target user's row of final_df.T.corr() is needed. The correlations of the target with every candidate
+# are computed at once over the co-rated movies (pairwise-complete, like DataFrame.corr): the target has rated all
+# of the watched movies, so the co-rated movies of a pair are the ones the candidate rated.
+def target_user_correlations(random_user_df, candidates_df):
+    x = random_user_df.values.ravel().astype(np.float64)
+    y = candidates_df.values.astype(np.float64)
+    rated = ~np.isnan(y)
+    n = rated.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dx = np.where(rated, x - (rated * x).sum(axis=1, keepdims=True) / n[:, None], 0)
+        dy = np.where(rated, y - np.where(rated, y, 0).sum(axis=1, keepdims=True) / n[:, None], 0)
+        corr = (dx * dy).sum(axis=1) / np.sqrt((dx ** 2).sum(axis=1) * (dy ** 2).sum(axis=1))
+    return pd.DataFrame({"userId": candidates_df.index.values, "corr": corr})
+
+
+# Inverted index: the CSC form of the user movie matrix lists, for each movie, the users who rated it (and their
+# ratings). It is built once and kept in the user movie matrix.
+def movie_user_index(user_movie_matrix):
+    if "movie_users" not in user_movie_matrix:
+        user_movie_matrix["movie_users"] = user_movie_matrix["ratings"].tocsc()
+    return user_movie_matrix["movie_users"]
+
+
+# Sparse user movie matrix (movielens.py): the co-watch counts come from merging the posting lists of the watched
+# movies in the inverted index, so only the users who share a movie with the target are touched, and only the
+# users who watched enough of the same movies are densified into movies_watched_df.
+def watched_frames_from_matrix(random_user, user_movie_matrix, ratio):
+    movie_users = movie_user_index(user_movie_matrix)
+    user_row = user_movie_matrix["user_index"].get_loc(random_user)
+    user_ratings = user_movie_matrix["ratings"][user_row]
+    watched = user_ratings.indices
+    movies_watched = user_movie_matrix["titles"][watched].tolist()
+    positions, lengths = gather_rows(movie_users.indptr, watched)
+    users = movie_users.indices[positions]
+    candidates, counts = np.unique(users, return_counts=True)
+    perc = len(movies_watched) * ratio / 100
+    same_movies = counts > perc
+    users_same_movies = pd.Series(user_movie_matrix["user_ids"][candidates[same_movies]], name="userId")
+    # Row of each posting entry in movies_watched_df (-1 when the user doesn't pass the overlap filter)
+    rows = np.where(same_movies, np.cumsum(same_movies) - 1, -1)[np.searchsorted(candidates, users)]
+    columns = np.repeat(np.arange(len(watched)), lengths)
+    values = np.full((same_movies.sum(), len(watched)), np.nan)
+    values[rows[rows >= 0], columns[rows >= 0]] = movie_users.data[positions][rows >= 0]
+    movies_watched_df = pd.DataFrame(values, index=users_same_movies.values, columns=movies_watched)
+    random_user_df = pd.DataFrame(user_ratings.data[None, :], index=[random_user], columns=movies_watched)
+    return random_user_df, movies_watched, movies_watched_df, users_same_movies
+
+
 def user_based_recommender(random_user, user_movie_df, ratio=60, cor_th=0.65, score=3.5):
     import pandas as pd
-    random_user_df = user_movie_df[user_movie_df.index == random_user]
-    movies_watched = random_user_df.columns[random_user_df.notna().any()].tolist()
-    movies_watched_df = user_movie_df[movies_watched]
-    user_movie_count = movies_watched_df.T.notnull().sum()
-    user_movie_count = user_movie_count.reset_index()
-    user_movie_count.columns = ["userId", "movie_count"]
-    perc = len(movies_watched) * ratio / 100
-    users_same_movies = user_movie_count[user_movie_count["movie_count"] > perc]["userId"]
-
-    final_df = pd.concat(
-        [movies_watched_df[movies_watched_df.index.isin(users_same_movies)], random_user_df[movies_watched]])
-    corr_matrix = final_df.T.corr()
-    corr_matrix.index = [f"{i}_{n}" if corr_matrix.index.duplicated()[n] else str(i)
-                         for n, i in enumerate(corr_matrix.index)]
-    corr_matrix.columns = corr_matrix.index
-    corr_df = corr_matrix.unstack().sort_values().drop_duplicates()
-    corr_df = pd.DataFrame(corr_df, columns=["corr"])
-    corr_df.index.names = ['user_id_1', 'user_id_2']
-    corr_df = corr_df.reset_index()
-    corr_df["user_id_1"] = corr_df["user_id_1"].astype(float)
-    corr_df["user_id_2"] = corr_df["user_id_2"].astype(float)
-
-    top_users = corr_df[(corr_df["user_id_1"] == random_user) & (corr_df["corr"] >= 0.65)][["user_id_2", "corr"]].reset_index(drop=True)
-    top_users = top_users.sort_values(by='corr', ascending=False)
-    top_users.rename(columns={"user_id_2": "userId"}, inplace=True)
-    rating = pd.read_csv('datasets/movie_lens_dataset/rating.csv')
+    if isinstance(user_movie_df, dict):
+        random_user_df, movies_watched, movies_watched_df, users_same_movies = \
+            watched_frames_from_matrix(random_user, user_movie_df, ratio)
+    else:
+        random_user_df = user_movie_df[user_movie_df.index == random_user]
+        movies_watched = random_user_df.columns[random_user_df.notna().any()].tolist()
+        movies_watched_df = user_movie_df[movies_watched]
+        user_movie_count = movies_watched_df.T.notnull().sum()
+        user_movie_count = user_movie_count.reset_index()
+        user_movie_count.columns = ["userId", "movie_count"]
+        perc = len(movies_watched) * ratio / 100
+        users_same_movies = user_movie_count[user_movie_count["movie_count"] > perc]["userId"]
+
+    candidates_df = movies_watched_df[movies_watched_df.index.isin(users_same_movies) &
+                                      (movies_watched_df.index != random_user)]
+    corr_df = target_user_correlations(random_user_df[movies_watched], candidates_df)
+
+    top_users = corr_df[corr_df["corr"] >= cor_th].reset_index(drop=True)
+    top_users = top_users.sort_values(by='corr', ascending=False, kind="stable")
+    rating = load_ratings()
     top_users_ratings = top_users.merge(rating[["userId", "movieId", "rating"]], how='inner')
     top_users_ratings['weighted_rating'] = top_users_ratings['corr'] * top_users_ratings['rating']
 
@@ -211,7 +266,7 @@ def user_based_recommender(random_user, user_movie_df, ratio=60, cor_th=0.65, sc
     recommendation_df = recommendation_df.reset_index()
 
     movies_to_be_recommend = recommendation_df[recommendation_df["weighted_rating"] > score].sort_values("weighted_rating", ascending=False)
-    movie = pd.read_csv('datasets/movie_lens_dataset/movie.csv')
+    movie = load_movies()
     return movies_to_be_recommend.merge(movie[["movieId", "title"]])
 
 
@@ -220,3 +275,294 @@ random_user = int(pd.Series(user_movie_df.index).sample(1).values)
 user_based_recommender(random_user, user_movie_df)
 random_user = int(pd.Series(user_movie_df.index).sample(1).values)
 user_based_recommender(random_user, user_movie_df, score=3.2)
+
+
+#############################################
+# Step 7: Running on the Sparse User Movie Matrix
+#############################################
+# create_user_movie_matrix (movielens.py) keeps the ratings in a float32 CSR matrix instead of the dense, mostly
+# NaN user_movie_df; user_based_recommender accepts it in place of user_movie_df.
+
+user_movie_matrix = create_user_movie_matrix()
+
+random_user = int(pd.Series(user_movie_matrix["user_ids"]).sample(1).values[0])
+user_based_recommender(random_user, user_movie_matrix)
+
+
+#############################################
+# Step 8: Keeping the Ratings Resident
+#############################################
+# user_based_recommender loads rating.csv and movie.csv on every call just to merge the top users' ratings and to
+# attach the titles. The recommender object keeps them resident instead:
+## the ratings grouped by user in a CSR-style layout (sorted user ids, row offsets, movieIds and ratings)
+## a movieId -> title array
+# The weighted ratings of the top users are gathered with one fancy index over their rows and averaged per movie
+# with np.bincount (a scatter-add), so a request does no disk I/O.
+
+class UserBasedRecommender:
+    def __init__(self, user_movie_matrix, rating, movie, graph=None):
+        self.user_movie_matrix = user_movie_matrix
+        # Optional user-user kNN graph (Step 10), read instead of correlating the users for the users whose rows
+        # were built, with the ratio of the build
+        self.graph = graph
+        order = np.argsort(rating["userId"].values, kind="stable")
+        user_ids = rating["userId"].values[order]
+        self.user_ids, counts = np.unique(user_ids, return_counts=True)
+        self.indptr = np.concatenate([[0], np.cumsum(counts)])
+        self.movie_ids = rating["movieId"].values[order].astype(np.int32)
+        self.ratings = rating["rating"].values[order].astype(np.float32)
+        self.titles = np.full(int(movie["movieId"].max()) + 1, None, dtype=object)
+        self.titles[movie["movieId"].values] = movie["title"].values
+
+    def _arrays(self):
+        ratings = self.user_movie_matrix["ratings"]
+        movie_users = movie_user_index(self.user_movie_matrix)
+        return {"matrix_data": ratings.data, "matrix_indices": ratings.indices, "matrix_indptr": ratings.indptr,
+                "inverted_data": movie_users.data, "inverted_indices": movie_users.indices,
+                "inverted_indptr": movie_users.indptr,
+                "matrix_user_ids": self.user_movie_matrix["user_ids"],
+                "matrix_titles": self.user_movie_matrix["titles"],
+                "user_ids": self.user_ids, "indptr": self.indptr, "movie_ids": self.movie_ids,
+                "ratings": self.ratings, "titles": self.titles}
+
+    @classmethod
+    def _from_arrays(cls, arrays, graph=None):
+        recommender = cls.__new__(cls)
+        user_ids, titles = arrays["matrix_user_ids"], arrays["matrix_titles"]
+        shape = (len(user_ids), len(titles))
+        recommender.user_movie_matrix = {
+            "ratings": csr_matrix((arrays["matrix_data"], arrays["matrix_indices"], arrays["matrix_indptr"]),
+                                  shape=shape, copy=False),
+            "movie_users": csc_matrix((arrays["inverted_data"], arrays["inverted_indices"],
+                                       arrays["inverted_indptr"]), shape=shape, copy=False),
+            "user_ids": user_ids,
+            "user_index": pd.Index(user_ids),
+            "titles": titles,
+            "title_index": pd.Index(titles)}
+        for name in ["user_ids", "indptr", "movie_ids", "ratings", "titles"]:
+            setattr(recommender, name, arrays[name])
+        recommender.graph = graph
+        return recommender
+
+    # The model is persisted in the shared model store (model_store.py): serving workers attach to a published
+    # version and memory-map its arrays, so the ratings are mapped once per host whatever the number of workers
+    def publish(self, store_dir, name="user_based"):
+        arrays = self._arrays()
+        meta = {}
+        if self.graph is not None:
+            graph_arrays, meta = user_graph_arrays(self.graph)
+            arrays.update(graph_arrays)
+        return publish_model(store_dir, name, arrays, meta)
+
+    @classmethod
+    def attach(cls, store_dir, name="user_based", version=None):
+        model = attach_model(store_dir, name, version)
+        arrays = model["arrays"]
+        graph = user_graph_from_arrays(arrays, model["meta"]) if "graph_indptr" in arrays else None
+        recommender = cls._from_arrays(arrays, graph)
+        recommender.version = model["version"]
+        return recommender
+
+    def top_users(self, random_user, ratio=60, cor_th=0.65):
+        # The overlap filter (ratio) was applied when the graph was built: users outside the graph and other ratios
+        # are correlated online
+        user_row = self.user_movie_matrix["user_index"].get_loc(random_user)
+        if self.graph is not None and self.graph["ratio"] == ratio and self.graph["built"][user_row]:
+            neighbors = self.graph["neighbors"]
+            start, stop = neighbors.indptr[user_row], neighbors.indptr[user_row + 1]
+            top_users = pd.DataFrame({"userId": self.user_movie_matrix["user_ids"][neighbors.indices[start:stop]],
+                                      "corr": neighbors.data[start:stop].astype(np.float64)})
+            return top_users[top_users["corr"] >= cor_th].reset_index(drop=True)
+        random_user_df, movies_watched, movies_watched_df, users_same_movies = \
+            watched_frames_from_matrix(random_user, self.user_movie_matrix, ratio)
+        candidates_df = movies_watched_df[movies_watched_df.index != random_user]
+        corr_df = target_user_correlations(random_user_df[movies_watched], candidates_df)
+        top_users = corr_df[corr_df["corr"] >= cor_th].reset_index(drop=True)
+        return top_users.sort_values(by='corr', ascending=False, kind="stable")
+
+    def weighted_ratings(self, user_ids, weights):
+        # Gather the rating rows of the users ...
+        positions, lengths = gather_rows(self.indptr, np.searchsorted(self.user_ids, user_ids))
+        movie_ids = self.movie_ids[positions]
+        # ... and average the weighted ratings per movie
+        sums = np.bincount(movie_ids, weights=np.repeat(weights, lengths) * self.ratings[positions],
+                           minlength=len(self.titles))
+        counts = np.bincount(movie_ids, minlength=len(self.titles))
+        rated = np.nonzero(counts)[0]
+        return rated, sums[rated] / counts[rated]
+
+    def recommend(self, random_user, ratio=60, cor_th=0.65, score=3.5):
+        top_users = self.top_users(random_user, ratio, cor_th)
+        movie_ids, weighted_rating = self.weighted_ratings(top_users["userId"].values, top_users["corr"].values)
+        recommendation_df = pd.DataFrame({"movieId": movie_ids, "weighted_rating": weighted_rating})
+        movies_to_be_recommend = recommendation_df[recommendation_df["weighted_rating"] > score]. \
+            sort_values("weighted_rating", ascending=False, kind="stable").reset_index(drop=True)
+        movies_to_be_recommend["title"] = self.titles[movies_to_be_recommend["movieId"].values]
+        return movies_to_be_recommend
+
+
+recommender = UserBasedRecommender(user_movie_matrix, load_ratings(), load_movies())
+
+random_user = int(pd.Series(user_movie_matrix["user_ids"]).sample(1).values[0])
+recommender.recommend(random_user)
+recommender.recommend(random_user, cor_th=0.5, score=3.2)
+
+# One publisher, many serving workers
+recommender.publish("models/store")
+recommender = UserBasedRecommender.attach("models/store")
+recommender.recommend(random_user)
+
+
+#############################################
+# Step 9: Batch Recommendations for All Users
+#############################################
+# Recommendations are precomputed for every user each night. The users are split into shards that run in a
+# process pool; every worker attaches to the model published in the model store (UserBasedRecommender.publish), so
+# the rating matrix is shared read-only through the page cache instead of being copied into each process.
+# Each finished shard is written to <output_dir>/shard-<n>.csv (userId, movieId, weighted_rating) under a
+# temporary name and renamed, so an interrupted job is resumed by running it again: shards whose file exists are
+# skipped. Shards are independent, so the job scales with the number of cores.
+# The shards are slices of the user_ids list, so <output_dir>/job.json records the list (its hash and length), the
+# shard size and the model version: a run with another list or shard size is refused instead of mixing its shards
+# with the old ones, and a resumed job uses the model version it started with.
+
+def _recommend_shard(store_dir, name, version, output_dir, shard, user_ids, ratio, cor_th, score):
+    recommender = UserBasedRecommender.attach(store_dir, name, version)
+    frames = []
+    for user_id in user_ids:
+        recommendations = recommender.recommend(user_id, ratio=ratio, cor_th=cor_th, score=score)
+        recommendations.insert(0, "userId", user_id)
+        frames.append(recommendations[["userId", "movieId", "weighted_rating"]])
+    path = os.path.join(output_dir, f"shard-{shard:05d}.csv")
+    pd.concat(frames, ignore_index=True).to_csv(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+    return len(user_ids)
+
+
+def _batch_job(output_dir, job):
+    path = os.path.join(output_dir, "job.json")
+    if not os.path.exists(path):
+        with open(path + ".tmp", "w") as file:
+            json.dump(job, file)
+        os.replace(path + ".tmp", path)
+        return job
+    with open(path) as file:
+        started = json.load(file)
+    if {key: started[key] for key in ["users_sha1", "n_users", "shard_size"]} != \
+            {key: job[key] for key in ["users_sha1", "n_users", "shard_size"]}:
+        raise ValueError(f"{output_dir} holds the shards of another user list or shard size, "
+                         "use a new output directory")
+    return started
+
+
+def batch_user_based_recommendations(store_dir, output_dir, user_ids=None, name="user_based", shard_size=1000,
+                                     n_jobs=-1, ratio=60, cor_th=0.65, score=3.5):
+    os.makedirs(output_dir, exist_ok=True)
+    model = attach_model(store_dir, name)
+    user_ids = np.asarray(model["arrays"]["matrix_user_ids"] if user_ids is None else user_ids, dtype=np.int64)
+    job = _batch_job(output_dir, {"users_sha1": hashlib.sha1(user_ids.tobytes()).hexdigest(),
+                                  "n_users": len(user_ids), "shard_size": shard_size, "version": model["version"]})
+    n_shards = int(np.ceil(len(user_ids) / shard_size))
+    shards = np.array_split(user_ids, n_shards) if n_shards else []
+    todo = [shard for shard in range(len(shards))
+            if not os.path.exists(os.path.join(output_dir, f"shard-{shard:05d}.csv"))]
+    done_users = len(user_ids) - sum(len(shards[shard]) for shard in todo)
+    print(f"{len(shards) - len(todo)}/{len(shards)} shards already done")
+    results = Parallel(n_jobs=n_jobs, return_as="generator_unordered")(
+        delayed(_recommend_shard)(store_dir, name, job["version"], output_dir, shard, shards[shard].tolist(), ratio,
+                                  cor_th, score)
+        for shard in todo)
+    for n_done, n_users in enumerate(results, start=1):
+        done_users += n_users
+        print(f"{len(shards) - len(todo) + n_done}/{len(shards)} shards, {done_users}/{len(user_ids)} users")
+
+
+# The nightly job runs over all the users (user_ids=None); the walkthrough runs it for a sample of them
+sample_user_ids = np.union1d(pd.Series(user_movie_matrix["user_ids"]).sample(1000, random_state=42).values,
+                             [random_user])
+batch_user_based_recommendations("models/store", "outputs/user_based_recommendations_sample",
+                                 user_ids=sample_user_ids)
+
+
+#############################################
+# Step 10: Persisted User-User kNN Graph
+#############################################
+# Finding the similar users from scratch on every call is replaced by an offline build of every user's top-k most
+# correlated neighbors, with the same minimum overlap filter as user_based_recommender: a neighbor has to have
+# rated more than ratio% of the user's movies. The users are processed in blocks (in a process pool) and the
+# pairwise-complete statistics of a block against all users are sparse matrix products, as in the item-based model:
+## n = M_b M' (co-rated movies), sx = R_b M', sy = M_b R', sxx = R_b^2 M', syy = M_b (R^2)', sxy = R_b R'
+# The graph holds:
+## neighbors   - CSR matrix over the rows of the user movie matrix: int32 neighbor rows and float32 correlations,
+##               ordered by descending correlation
+## built       - the rows that were built (user_ids limits the build to some users)
+## ratio, k    - the parameters of the build
+# It is published with the recommender (graph_* arrays and meta in the model store) and memory-mapped on attach.
+# With a graph, UserBasedRecommender reads the neighbors (at most k of them) instead of correlating the users.
+
+def _user_knn_rows(operands, rows, k, ratio):
+    block_ratings, block_rated = operands["ratings"][rows], operands["rated"][rows]
+    n = (block_rated @ operands["rated_t"]).toarray()
+    sx, sy = (block_ratings @ operands["rated_t"]).toarray(), (block_rated @ operands["ratings_t"]).toarray()
+    sxx = (operands["squares"][rows] @ operands["rated_t"]).toarray()
+    syy = (block_rated @ operands["squares_t"]).toarray()
+    sxy = (block_ratings @ operands["ratings_t"]).toarray()
+    corr = pearson_from_sums(n, sx, sy, sxx, syy, sxy)
+    n_watched = np.diff(block_rated.indptr)
+    valid = ~np.isnan(corr) & (n > n_watched[:, None] * ratio / 100)
+    valid[np.arange(len(rows)), rows] = False
+    top, top_corr = top_k_rows(np.where(valid, corr, -np.inf), k)
+    keep = np.isfinite(top_corr)
+    return np.count_nonzero(keep, axis=1), top[keep].astype(np.int32), top_corr[keep].astype(np.float32)
+
+
+def build_user_knn_graph(user_movie_matrix, k=100, ratio=60, user_ids=None, block_size=64, n_jobs=-1):
+    ratings = user_movie_matrix["ratings"].astype(np.float64)
+    n_users = ratings.shape[0]
+    # user_ids limits the build to the rows of some users, the rows of the others are left empty
+    rows = np.arange(n_users) if user_ids is None else np.unique(user_movie_matrix["user_index"].get_indexer(user_ids))
+    rows = rows[rows >= 0]
+    # The operands of the products are built once (the right-hand sides transposed to CSR), the workers share
+    # them: joblib memory-maps the large arrays it sends to the process pool
+    rated = ratings.copy()
+    rated.data[:] = 1
+    squares = ratings.multiply(ratings).tocsr()
+    operands = {"ratings": ratings, "rated": rated, "squares": squares,
+                "ratings_t": ratings.T.tocsr(), "rated_t": rated.T.tocsr(), "squares_t": squares.T.tocsr()}
+    results = Parallel(n_jobs=n_jobs)(delayed(_user_knn_rows)(operands, rows[start:start + block_size], k, ratio)
+                                      for start in range(0, len(rows), block_size))
+    lengths = np.zeros(n_users, dtype=np.int64)
+    lengths[rows] = np.concatenate([result[0] for result in results])
+    built = np.zeros(n_users, dtype=bool)
+    built[rows] = True
+    neighbors = csr_matrix((np.concatenate([result[2] for result in results]),
+                            np.concatenate([result[1] for result in results]),
+                            np.concatenate([[0], np.cumsum(lengths)])), shape=(n_users, n_users))
+    return {"neighbors": neighbors, "built": built, "ratio": ratio, "k": k}
+
+
+def user_graph_arrays(graph):
+    neighbors = graph["neighbors"]
+    arrays = {"graph_indptr": neighbors.indptr.astype(np.int64),
+              "graph_indices": neighbors.indices.astype(np.int32),
+              "graph_weights": neighbors.data.astype(np.float32),
+              "graph_built": graph["built"]}
+    return arrays, {"graph_ratio": graph["ratio"], "graph_k": graph["k"]}
+
+
+def user_graph_from_arrays(arrays, meta):
+    n_users = len(arrays["graph_indptr"]) - 1
+    # copy=False keeps the graph backed by the memory-mapped files
+    neighbors = csr_matrix((arrays["graph_weights"], arrays["graph_indices"], arrays["graph_indptr"]),
+                           shape=(n_users, n_users), copy=False)
+    return {"neighbors": neighbors, "built": arrays["graph_built"], "ratio": meta["graph_ratio"],
+            "k": meta["graph_k"]}
+
+
+# The full graph is an offline job over all the users (user_ids=None); the walkthrough builds the rows of the sample
+user_graph = build_user_knn_graph(user_movie_matrix, k=100, ratio=60, user_ids=sample_user_ids)
+recommender.graph = user_graph
+recommender.publish("models/store")
+
+recommender = UserBasedRecommender.attach("models/store")
+recommender.recommend(random_user)
@@ -0,0 +1,90 @@
+###########################################
+# Binary Columnar Cache
+###########################################
+# Parsing the source files (rating.csv has 20M rows) takes tens of seconds and used to be paid by every script run
+# and even by every user_based_recommender call. cached_frame parses a source file once, stores each column as a
+# .npy file and memory-maps the columns on later loads, which takes well under a second.
+
+# Cache layout: <cache_dir>/<file name>-<mtime_ns>-<size>/
+## meta.json                 - column order and how each column is stored
+## <column>.npy              - numeric, bool and datetime64 columns, memory-mapped on load
+## <column>.codes.npy        - category and string columns: integer codes (memory-mapped) ...
+## <column>.categories.npy   - ... and their categories
+# The directory name is the cache key: a source file with another mtime or size gets a new cache and the stale
+# ones are removed. A cache is written to a temporary directory and renamed, so readers never see half of one.
+
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+
+def _cache_path(source_path, cache_dir):
+    stat = os.stat(source_path)
+    cache_dir = cache_dir or os.path.join(os.path.dirname(source_path), ".cache")
+    name = os.path.basename(source_path)
+    return cache_dir, name, os.path.join(cache_dir, f"{name}-{stat.st_mtime_ns}-{stat.st_size}")
+
+
+def _codes_dtype(n_categories):
+    return np.int8 if n_categories < 2 ** 7 else np.int16 if n_categories < 2 ** 15 else np.int32
+
+
+def write_frame(dataframe, path):
+    tmp_path = path + f".tmp-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    columns = []
+    for column in dataframe.columns:
+        values = dataframe[column]
+        file_name = os.path.join(tmp_path, str(column))
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            kind, categorical = "category", values.array
+        elif isinstance(values.dtype, np.dtype) and values.dtype.kind in "biufcmM":
+            kind = "array"
+            np.save(file_name + ".npy", values.values)
+        else:
+            # Strings are stored as codes, so that they can be memory-mapped as well
+            kind, categorical = "object", pd.Categorical(values)
+        if kind != "array":
+            np.save(file_name + ".codes.npy",
+                    categorical.codes.astype(_codes_dtype(len(categorical.categories))))
+            np.save(file_name + ".categories.npy", np.asarray(categorical.categories, dtype=object),
+                    allow_pickle=True)
+        columns.append({"name": str(column), "kind": kind})
+    with open(os.path.join(tmp_path, "meta.json"), "w") as file:
+        json.dump({"columns": columns}, file)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # Another process published the same cache first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def read_frame(path):
+    with open(os.path.join(path, "meta.json")) as file:
+        meta = json.load(file)
+    data = {}
+    for column in meta["columns"]:
+        file_name = os.path.join(path, column["name"])
+        if column["kind"] == "array":
+            data[column["name"]] = np.load(file_name + ".npy", mmap_mode="r")
+            continue
+        categorical = pd.Categorical.from_codes(np.load(file_name + ".codes.npy", mmap_mode="r"),
+                                                categories=np.load(file_name + ".categories.npy",
+                                                                   allow_pickle=True))
+        data[column["name"]] = categorical if column["kind"] == "category" else np.asarray(categorical, dtype=object)
+    # copy=False keeps the columns backed by the memory-mapped files
+    return pd.DataFrame(data, copy=False)
+
+
+def cached_frame(source_path, read_function, cache_dir=None):
+    cache_dir, name, path = _cache_path(source_path, cache_dir)
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        dataframe = read_function(source_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        for stale in os.listdir(cache_dir):
+            if stale.startswith(name + "-") and not stale.startswith(os.path.basename(path)):
+                shutil.rmtree(os.path.join(cache_dir, stale), ignore_errors=True)
+        write_frame(dataframe, path)
+    return read_frame(path)
@@ -3,23 +3,32 @@
 #############################
 
 # !pip install scikit-surprise
+import time
+from bisect import bisect_right
+import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
+from scipy.sparse import csr_matrix
 from surprise import Reader, SVD, Dataset, accuracy
 from surprise.model_selection import GridSearchCV, train_test_split, cross_validate
+from array_ops import gather_rows
+from model_store import attach_model, publish_model
+from movielens import load_movies, load_ratings
 pd.set_option('display.max_columns', None)
 
 # Step 1: Dataset Preparation
 # Step 2: Modeling
 # Step 3: Model Tuning
 # Step 4: Final Model and Estimation
-
+# Step 5: Serving the Model from the Shared Model Store
+# Step 6: Training on the Full Dataset with ALS
 
 
 #############################
 # Step 1: Dataset Preparation
 #############################
-movie = pd.read_csv('datasets/movie_lens_dataset/movie.csv')
-rating = pd.read_csv('datasets/movie_lens_dataset/rating.csv')
+movie = load_movies()
+rating = load_ratings()
 
 df = movie.merge(rating, how="left", on="movieId")
 df.head()
@@ -120,4 +129,186 @@ svd_model = SVD(**gs.best_params['rmse'])
 data = data.build_full_trainset()
 svd_model.fit(data)
 
-svd_model.predict(uid=1.0, iid=541, verbose=True)
\ No newline at end of file
+svd_model.predict(uid=1.0, iid=541, verbose=True)
+
+
+##############################
+# Step 5: Serving the Model from the Shared Model Store
+##############################
+# Pickling the fitted SVD into every serving worker duplicates the factors (and the whole trainset) per process.
+# Only the factor and bias arrays are published to the model store (model_store.py), float32 and sorted by raw id,
+# and the workers attach to them with read-only memory maps. svd_predict is the estimate of the biased SVD for
+# arrays of (user, movie) pairs: global_mean + bu + bi + qi.pu, dropping the terms of unknown users / movies and
+# clipped to the rating scale, like svd_model.predict.
+
+def svd_model_arrays(svd_model):
+    trainset = svd_model.trainset
+    user_ids = np.array([trainset.to_raw_uid(inner_id) for inner_id in trainset.all_users()])
+    item_ids = np.array([trainset.to_raw_iid(inner_id) for inner_id in trainset.all_items()])
+    user_order, item_order = np.argsort(user_ids, kind="stable"), np.argsort(item_ids, kind="stable")
+    arrays = {"user_ids": user_ids[user_order],
+              "item_ids": item_ids[item_order],
+              "pu": svd_model.pu[user_order].astype(np.float32),
+              "bu": svd_model.bu[user_order].astype(np.float32),
+              "qi": svd_model.qi[item_order].astype(np.float32),
+              "bi": svd_model.bi[item_order].astype(np.float32)}
+    meta = {"global_mean": float(trainset.global_mean), "rating_scale": list(trainset.rating_scale)}
+    return arrays, meta
+
+
+def _inner_ids(ids, raw_ids):
+    positions = np.minimum(np.searchsorted(ids, raw_ids), len(ids) - 1)
+    return positions, ids[positions] == raw_ids
+
+
+def svd_predict(svd_arrays, user_ids, movie_ids):
+    arrays, meta = svd_arrays["arrays"], svd_arrays["meta"]
+    users, known_users = _inner_ids(arrays["user_ids"], np.asarray(user_ids))
+    items, known_items = _inner_ids(arrays["item_ids"], np.asarray(movie_ids))
+    estimate = np.full(len(users), meta["global_mean"])
+    estimate += np.where(known_users, arrays["bu"][users], 0) + np.where(known_items, arrays["bi"][items], 0)
+    both = known_users & known_items
+    estimate[both] += np.einsum("ij,ij->i", arrays["pu"][users[both]], arrays["qi"][items[both]])
+    return np.clip(estimate, *meta["rating_scale"])
+
+
+svd_arrays, svd_meta = svd_model_arrays(svd_model)
+publish_model("models/store", "svd", svd_arrays, svd_meta)
+
+svd_arrays = attach_model("models/store", "svd")
+svd_predict(svd_arrays, [1.0, 1.0], [541, 356])
+
+
+##############################
+# Step 6: Training on the Full Dataset with ALS
+##############################
+# surprise's SVD is trained with single-threaded SGD, so the study above only uses four movies. ALSFactorization
+# trains the same biased model (global_mean + bu + bi + qi.pu) on all the ratings with alternating least squares:
+# with the item factors fixed, each user's [pu, bu] is a small ridge regression of r - global_mean - bi on [qi, 1]
+# over the movies the user rated, and the other way round for the movies. The regularization is weighted by the
+# number of ratings (ALS-WR): (X'X + reg * n I) w = X't.
+## The users (movies) are sorted by their number of ratings and grouped into batches of similar length, padded to
+## the longest one, so the Gram matrices X'X of a batch are one batched np.matmul and the systems one batched
+## np.linalg.solve. Both release the GIL, so the batches run on all the cores in a thread pool.
+## Factors are float32 and every epoch reports the training RMSE (and the test RMSE when a test set is given).
+# model_arrays has the layout of svd_model_arrays, so svd_predict and the model store serve the ALS model as well.
+
+class ALSFactorization:
+    def __init__(self, n_factors=50, n_epochs=10, reg=0.05, init_std=0.1, rating_scale=(0.5, 5.0), n_jobs=-1,
+                 batch_entries=2 ** 18, random_state=42):
+        self.n_factors, self.n_epochs, self.reg, self.init_std = n_factors, n_epochs, reg, init_std
+        self.rating_scale, self.n_jobs, self.random_state = rating_scale, n_jobs, random_state
+        # Upper bound of padded ratings per batch (memory: batch_entries * (n_factors + 1) float32)
+        self.batch_entries = batch_entries
+
+    def _batches(self, counts):
+        # Rows sorted by their number of ratings, cut so that rows x longest row <= batch_entries
+        order = np.argsort(counts, kind="stable")
+        sorted_counts = counts[order]
+        batches, start = [], 0
+        while start < len(order):
+            size = bisect_right(range(start + 1, len(order) + 1), self.batch_entries,
+                                key=lambda stop: (stop - start) * sorted_counts[stop - 1])
+            batches.append(order[start:start + max(size, 1)])
+            start += max(size, 1)
+        return batches
+
+    def _solve_batch(self, indptr, indices, factors, targets, rows):
+        positions, lengths = gather_rows(indptr, rows)
+        offsets = np.cumsum(lengths) - lengths
+        batch_rows, slots = np.repeat(np.arange(len(rows)), lengths), np.arange(lengths.sum()) - np.repeat(offsets, lengths)
+        x = np.zeros((len(rows), max(lengths.max(), 1), factors.shape[1]), dtype=np.float32)
+        t = np.zeros((len(rows), x.shape[1], 1), dtype=np.float32)
+        x[batch_rows, slots] = factors[indices[positions]]
+        t[batch_rows, slots, 0] = targets[positions]
+        xt = x.transpose(0, 2, 1)
+        gram = xt @ x + (self.reg * np.maximum(lengths, 1))[:, None, None].astype(np.float32) * \
+            np.eye(factors.shape[1], dtype=np.float32)
+        return np.linalg.solve(gram, xt @ t)[..., 0]
+
+    def _solve(self, matrix, batches, factors, targets):
+        # One regression per row of matrix (CSR: users, CSC: movies) on the factors of its columns
+        factors = np.hstack([factors, np.ones((len(factors), 1), dtype=np.float32)])
+        solutions = Parallel(n_jobs=self.n_jobs, prefer="threads")(
+            delayed(self._solve_batch)(matrix.indptr, matrix.indices, factors, targets, rows) for rows in batches)
+        solution = np.zeros((len(matrix.indptr) - 1, factors.shape[1]), dtype=np.float32)
+        for rows, rows_solution in zip(batches, solutions):
+            solution[rows] = rows_solution
+        return solution[:, :-1], solution[:, -1]
+
+    def _estimate(self, users, items, chunk_size=2 ** 20):
+        estimate = np.empty(len(users), dtype=np.float32)
+        for start in range(0, len(users), chunk_size):
+            user, item = users[start:start + chunk_size], items[start:start + chunk_size]
+            estimate[start:start + chunk_size] = self.global_mean + self.bu[user] + self.bi[item] + \
+                np.einsum("ij,ij->i", self.pu[user], self.qi[item])
+        return estimate
+
+    def fit(self, user_ids, movie_ids, ratings, test=None, verbose=True):
+        self.user_ids, users = np.unique(np.asarray(user_ids), return_inverse=True)
+        self.item_ids, items = np.unique(np.asarray(movie_ids), return_inverse=True)
+        ratings = np.asarray(ratings, dtype=np.float32)
+        self.global_mean = float(ratings.mean())
+        shape = (len(self.user_ids), len(self.item_ids))
+        by_user = csr_matrix((ratings, (users, items)), shape=shape)
+        if by_user.nnz < len(ratings):
+            # Duplicated (user, movie) pairs are summed by the CSR conversion, average them like movielens.py
+            counts = csr_matrix((np.ones(len(ratings), dtype=np.float32), (users, items)), shape=shape)
+            by_user.sum_duplicates()
+            counts.sum_duplicates()
+            by_user.data /= counts.data
+        by_item = by_user.tocsc()
+        user_batches, item_batches = self._batches(np.diff(by_user.indptr)), self._batches(np.diff(by_item.indptr))
+        rng = np.random.default_rng(self.random_state)
+        self.pu = rng.normal(0, self.init_std, (len(self.user_ids), self.n_factors)).astype(np.float32)
+        self.qi = rng.normal(0, self.init_std, (len(self.item_ids), self.n_factors)).astype(np.float32)
+        self.bu = np.zeros(len(self.user_ids), dtype=np.float32)
+        self.bi = np.zeros(len(self.item_ids), dtype=np.float32)
+        self.history = []
+        for epoch in range(1, self.n_epochs + 1):
+            start = time.perf_counter()
+            self.pu, self.bu = self._solve(by_user, user_batches, self.qi,
+                                           by_user.data - self.global_mean - self.bi[by_user.indices])
+            self.qi, self.bi = self._solve(by_item, item_batches, self.pu,
+                                           by_item.data - self.global_mean - self.bu[by_item.indices])
+            record = {"epoch": epoch, "seconds": time.perf_counter() - start,
+                      "train_rmse": float(np.sqrt(np.mean((self._estimate(users, items) - ratings) ** 2)))}
+            if test is not None:
+                record["test_rmse"] = self.rmse(*test)
+            self.history.append(record)
+            if verbose:
+                print(", ".join(f"{name}: {value:.4f}" if isinstance(value, float) else f"{name}: {value}"
+                                for name, value in record.items()))
+        return self
+
+    def model_arrays(self):
+        arrays = {"user_ids": self.user_ids, "item_ids": self.item_ids,
+                  "pu": self.pu, "bu": self.bu, "qi": self.qi, "bi": self.bi}
+        return arrays, {"global_mean": self.global_mean, "rating_scale": list(self.rating_scale)}
+
+    def predict(self, user_ids, movie_ids):
+        arrays, meta = self.model_arrays()
+        return svd_predict({"arrays": arrays, "meta": meta}, user_ids, movie_ids)
+
+    def rmse(self, user_ids, movie_ids, ratings):
+        return float(np.sqrt(np.mean((self.predict(user_ids, movie_ids) - np.asarray(ratings)) ** 2)))
+
+
+# Same 75% / 25% split for ALS and the SVD baseline, on all the ratings
+test_mask = np.random.default_rng(42).random(len(rating)) < 0.25
+train, test = rating[~test_mask], rating[test_mask]
+test_arrays = (test["userId"].values, test["movieId"].values, test["rating"].values)
+
+als_model = ALSFactorization(n_factors=50, n_epochs=10, reg=0.05)
+als_model.fit(train["userId"].values, train["movieId"].values, train["rating"].values, test=test_arrays)
+pd.DataFrame(als_model.history)
+
+# Baseline: surprise SVD on the same training set (single-threaded, slow on the full data)
+svd_full = SVD()
+svd_full.fit(Dataset.load_from_df(train[["userId", "movieId", "rating"]], Reader(rating_scale=(0.5, 5)))
+             .build_full_trainset())
+svd_full_arrays, svd_full_meta = svd_model_arrays(svd_full)
+np.sqrt(np.mean((svd_predict({"arrays": svd_full_arrays, "meta": svd_full_meta}, *test_arrays[:2]) -
+                 test_arrays[2]) ** 2))
+
+publish_model("models/store", "als", *als_model.model_arrays())
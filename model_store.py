@@ -0,0 +1,69 @@
+###########################################
+# Shared Model Store
+###########################################
+# Every serving worker used to build or load its own copy of the models (the user movie matrix, cosine_sim,
+# the SVD factors), so the memory of a host grew with the number of workers. A model is now published once as .npy
+# files and the workers attach to it with read-only memory maps: the pages live once in the OS page cache and are
+# shared by all the processes that map them, without any copy.
+
+# Store layout: <store_dir>/<model name>/
+## CURRENT                   - name of the published version directory
+## v-<version>/meta.json     - array names and the meta dictionary of the model
+## v-<version>/<array>.npy   - numeric arrays, memory-mapped on attach (object arrays are unpickled)
+# A version is written to a temporary directory and renamed, then CURRENT is replaced atomically (os.replace), so a
+# worker attaches to either the old or the new version, never to half of one. Workers keep using the version they
+# attached to and call attach_model again when current_version changes. Old versions are removed after a publish,
+# the files stay readable for the workers that still map them (POSIX keeps unlinked files alive).
+
+import json
+import os
+import shutil
+import time
+import numpy as np
+
+
+def current_version(store_dir, name):
+    try:
+        with open(os.path.join(store_dir, name, "CURRENT")) as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def publish_model(store_dir, name, arrays, meta=None, keep=2):
+    model_dir = os.path.join(store_dir, name)
+    version = f"v-{time.time_ns()}"
+    tmp_path = os.path.join(model_dir, f".tmp-{version}-{os.getpid()}")
+    os.makedirs(tmp_path)
+    for array_name, array in arrays.items():
+        array = np.asarray(array)
+        np.save(os.path.join(tmp_path, array_name + ".npy"), array, allow_pickle=array.dtype == object)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as file:
+        json.dump({"arrays": list(arrays), "meta": meta or {}}, file)
+    os.replace(tmp_path, os.path.join(model_dir, version))
+    pointer = os.path.join(model_dir, f".CURRENT-{os.getpid()}")
+    with open(pointer, "w") as file:
+        file.write(version)
+    os.replace(pointer, os.path.join(model_dir, "CURRENT"))
+    versions = sorted(entry for entry in os.listdir(model_dir) if entry.startswith("v-"))
+    for stale in versions[:-keep]:
+        shutil.rmtree(os.path.join(model_dir, stale), ignore_errors=True)
+    return version
+
+
+def attach_model(store_dir, name, version=None):
+    version = version or current_version(store_dir, name)
+    if version is None:
+        raise FileNotFoundError(f"No published version of {name} in {store_dir}")
+    path = os.path.join(store_dir, name, version)
+    with open(os.path.join(path, "meta.json")) as file:
+        meta = json.load(file)
+    arrays = {}
+    for array_name in meta["arrays"]:
+        file_name = os.path.join(path, array_name + ".npy")
+        try:
+            arrays[array_name] = np.load(file_name, mmap_mode="r")
+        except ValueError:
+            # Object arrays can't be memory-mapped
+            arrays[array_name] = np.load(file_name, allow_pickle=True)
+    return {"version": version, "meta": meta["meta"], "arrays": arrays}
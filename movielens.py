@@ -0,0 +1,83 @@
+###########################################
+# MovieLens Data Structures
+###########################################
+# Shared by cf_item_based.py, cf_user_based.py and matrix_factorization.py.
+
+# Loading:
+## load_movies and load_ratings parse movie.csv and rating.csv once into the binary columnar cache of
+## data_cache.py, with downcast dtypes (int32 ids, float32 ratings, datetime64 timestamps), and memory-map it on
+## later loads.
+
+# Sparse User Movie Matrix:
+## create_user_movie_df pivots rating.csv into a dense float64 DataFrame with NaN for missing ratings, about
+## 138k users x 3k titles, several gigabytes that are mostly NaN, and the pivot itself is slow.
+## create_user_movie_matrix builds the same table as a CSR matrix of float32 ratings (users x titles) with
+## integer index maps, without the pivot:
+### ratings     - csr_matrix (users x titles), float32, only the given ratings are stored
+### user_ids    - userId of each row (sorted, like the pivot_table index), user_index maps userId -> row
+### titles      - title of each column (sorted, like the pivot_table columns), title_index maps title -> column
+### movie_ids   - movieIds of the common movies, movie_cols the column of each of them
+## Like pivot_table, the ratings of a user for different movieIds with the same title are averaged.
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from data_cache import cached_frame
+
+
+def _read_movies(path):
+    return pd.read_csv(path, dtype={"movieId": np.int32})
+
+
+def _read_ratings(path):
+    rating = pd.read_csv(path, dtype={"userId": np.int32, "movieId": np.int32, "rating": np.float32})
+    rating["timestamp"] = pd.to_datetime(rating["timestamp"]).values.astype("datetime64[s]")
+    return rating
+
+
+def load_movies(path='datasets/movie_lens_dataset/movie.csv'):
+    return cached_frame(path, _read_movies)
+
+
+def load_ratings(path='datasets/movie_lens_dataset/rating.csv'):
+    return cached_frame(path, _read_ratings)
+
+
+def _user_movie_matrix(user_rows, title_cols, ratings, user_ids, titles):
+    shape = (len(user_ids), len(titles))
+    # Duplicated (user, title) pairs are summed by the CSR conversion; both matrices get the same structure
+    sums = csr_matrix((ratings.astype(np.float64), (user_rows, title_cols)), shape=shape)
+    counts = csr_matrix((np.ones(len(ratings)), (user_rows, title_cols)), shape=shape)
+    sums.sum_duplicates()
+    counts.sum_duplicates()
+    matrix = csr_matrix(((sums.data / counts.data).astype(np.float32), sums.indices, sums.indptr), shape=shape)
+    return {"ratings": matrix,
+            "user_ids": np.asarray(user_ids, dtype=np.int32),
+            "user_index": pd.Index(user_ids),
+            "titles": np.asarray(titles, dtype=object),
+            "title_index": pd.Index(titles)}
+
+
+def create_user_movie_matrix(movie_path='datasets/movie_lens_dataset/movie.csv',
+                             rating_path='datasets/movie_lens_dataset/rating.csv', min_count=1000):
+    movie = load_movies(movie_path)
+    rating = load_ratings(rating_path)
+    title_codes, titles = pd.factorize(movie["title"], sort=True)
+    rating_titles = title_codes[pd.Index(movie["movieId"]).get_indexer(rating["movieId"])]
+    # Same rare movie filter as create_user_movie_df
+    common = np.bincount(rating_titles, minlength=len(titles)) > min_count
+    title_cols = np.where(common, np.cumsum(common) - 1, -1)
+    keep = common[rating_titles]
+    user_rows, user_ids = pd.factorize(rating["userId"].values[keep], sort=True)
+    matrix = _user_movie_matrix(user_rows, title_cols[rating_titles[keep]], rating["rating"].values[keep],
+                                user_ids, titles[common])
+    common_movies = common[title_codes]
+    matrix["movie_ids"] = movie["movieId"].values[common_movies].astype(np.int32)
+    matrix["movie_cols"] = title_cols[title_codes[common_movies]].astype(np.int32)
+    return matrix
+
+
+def user_movie_matrix_from_df(user_movie_df):
+    users, items = np.nonzero(user_movie_df.notna().values)
+    return _user_movie_matrix(users, items, user_movie_df.values[users, items],
+                              user_movie_df.index, user_movie_df.columns)